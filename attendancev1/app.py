@@ -1,74 +1,486 @@
 import os
 import sys
 import base64
+import csv
+import functools
 import json
 import io
+import itertools
+import math
+import queue
+import random
+import re
+import time
+import threading
+import uuid
+import zipfile
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import quote
+from xml.sax.saxutils import escape as xml_escape
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Startup timings in milliseconds, served at /api/startup
+MODULE_LOAD_STARTED = time.perf_counter()
+startup_timings = {}
 
 import cv2
 import numpy as np
-from PIL import Image, ImageEnhance
-from flask import Flask, request, jsonify, render_template_string, send_file
+from PIL import Image
+from flask import Flask, Request, Response, g, request, jsonify, render_template_string, send_file
 
 # -----------------------------
 # 1) AWS Rekognition Setup
 # -----------------------------
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
 
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 AWS_REGION = os.getenv('AWS_REGION', 'us-east-1')
 COLLECTION_ID = "students"
 
-rekognition_client = boto3.client(
-    'rekognition',
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION
-)
+# Max number of concurrent search_faces_by_image calls per /recognize request
+SEARCH_MAX_WORKERS = int(os.getenv("SEARCH_MAX_WORKERS", "8"))
+
+# Tiled detection for large group photos (chosen per request with detection_mode=tiled)
+TILE_GRID = int(os.getenv("TILE_GRID", "3"))                                # Tiles per side
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", "0.25"))                     # Fraction of a tile shared with its neighbour
+TILE_DUPLICATE_OVERLAP = float(os.getenv("TILE_DUPLICATE_OVERLAP", "0.5"))  # Box overlap above which two detections are one face
+TILE_MAX_WORKERS = int(os.getenv("TILE_MAX_WORKERS", "9"))                  # Concurrent detect_faces calls
+
+# Local OpenCV pre-detection before the cloud detect_faces call (full-frame detection)
+PREDETECT_MODE = os.getenv("PREDETECT_MODE", "off")                            # off, gate (skip faceless photos) or crop (gate + crop to the faces)
+PREDETECT_CASCADE = os.getenv("PREDETECT_CASCADE", "haarcascade_frontalface_default.xml")  # File in cv2.data.haarcascades, or a path (e.g. an LBP cascade)
+PREDETECT_MIN_NEIGHBORS = int(os.getenv("PREDETECT_MIN_NEIGHBORS", "3"))       # Lower finds more candidates (fewer wrongly rejected photos)
+PREDETECT_CROP_MARGIN = float(os.getenv("PREDETECT_CROP_MARGIN", "0.5"))       # Margin around the candidates, as a fraction of the face size
+PREDETECT_MAX_CROP_AREA = float(os.getenv("PREDETECT_MAX_CROP_AREA", "0.8"))   # Send the whole photo when the crop would keep more than this
+
+# Background recognition jobs (POST /recognize?async=1)
+RECOGNITION_WORKERS = int(os.getenv("RECOGNITION_WORKERS", "2"))        # Jobs processed concurrently
+RECOGNITION_QUEUE_SIZE = int(os.getenv("RECOGNITION_QUEUE_SIZE", "20"))  # Jobs waiting before 503
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "3600"))             # Seconds finished jobs are kept
+RECOGNIZE_UI_ASYNC = os.getenv("RECOGNIZE_UI_ASYNC", "0") == "1"        # UI queues recognitions (needs one worker process or sticky sessions)
+
+# Live camera streams (POST /stream/start, then frames to /stream/<id>/frame)
+STREAM_MOTION_THRESHOLD = float(os.getenv("STREAM_MOTION_THRESHOLD", "0.01"))  # Fraction of pixels that must change
+STREAM_DETECT_INTERVAL = float(os.getenv("STREAM_DETECT_INTERVAL", "0.5"))     # Min seconds between detect_faces calls per stream
+STREAM_TRACK_IOU = float(os.getenv("STREAM_TRACK_IOU", "0.3"))                 # Overlap (IoU) that continues a track
+STREAM_TRACK_TTL = float(os.getenv("STREAM_TRACK_TTL", "3"))                   # Seconds a track survives without being seen
+STREAM_IDLE_TIMEOUT = float(os.getenv("STREAM_IDLE_TIMEOUT", "300"))           # Seconds before an idle stream is dropped
+STREAM_MAX_SESSIONS = int(os.getenv("STREAM_MAX_SESSIONS", "50"))              # Concurrent streams
+
+# Face search result cache (keyed by a perceptual hash of the face crop)
+FACE_CACHE_SIZE = int(os.getenv("FACE_CACHE_SIZE", "1024"))              # 0 disables the cache
+FACE_CACHE_TTL = float(os.getenv("FACE_CACHE_TTL", "3600"))              # Seconds
+FACE_CACHE_NEGATIVE_TTL = float(os.getenv("FACE_CACHE_NEGATIVE_TTL", "60"))  # Seconds "not recognized" is cached (0 = never)
+FACE_CACHE_MAX_DISTANCE = int(os.getenv("FACE_CACHE_MAX_DISTANCE", "3"))  # Hamming distance (of 64 bits)
+
+# Bulk enrollment (POST /register/bulk)
+BULK_MAX_WORKERS = int(os.getenv("BULK_MAX_WORKERS", "8"))          # Students decoded/indexed concurrently
+BULK_INDEX_TPS = float(os.getenv("BULK_INDEX_TPS", "5"))            # Max index_faces calls per second
+BULK_MAX_UPLOAD_MB = float(os.getenv("BULK_MAX_UPLOAD_MB", "512"))  # Request size limit for bulk uploads
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: acquire() blocks until a call is allowed,
+    so at most `rate` calls per second (bursts up to `burst`) go through.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Histogram buckets: seconds for latencies, faces for faces per request
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FACE_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+class Metrics:
+    """
+    Thread-safe histograms and counters rendered in the Prometheus text
+    format for /metrics. Values are per process.
+    """
+    def __init__(self):
+        self._meta = {}                  # name -> (type, help, buckets)
+        self._histograms = {}            # (name, labels) -> [bucket_counts, sum, count]
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help_text, buckets)
+
+    def counter(self, name, help_text):
+        self._meta[name] = ("counter", help_text, None)
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    @contextmanager
+    def time(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for k, v in pairs:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{k}="{v}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        with self._lock:
+            histograms = {key: (list(b), total, count) for key, (b, total, count) in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+                continue
+            for (metric, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(buckets, bucket_counts):
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', f'{bound:g}')])} {bucket_count}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("attendance_request_seconds", "Request latency by endpoint.")
+metrics.counter("attendance_requests_total", "Requests by endpoint, method and status.")
+metrics.histogram("attendance_stage_seconds", "Time spent in each stage of an endpoint.")
+metrics.histogram("attendance_faces_per_request", "Faces detected per recognition.", FACE_COUNT_BUCKETS)
+metrics.histogram("attendance_cloud_call_seconds", "Latency of each Rekognition, Firestore and Gemini call attempt.")
+metrics.counter("attendance_cloud_calls_total", "Cloud call attempts by service, operation and outcome.")
+metrics.counter("attendance_cloud_retries_total", "Cloud calls retried after a throttle or server error.")
+metrics.counter("attendance_chat_replies_total", "Chat replies by source (cache or gemini).")
+metrics.counter("attendance_stream_frames_total", "Live stream frames by outcome.")
+metrics.counter("attendance_predetect_total", "Local pre-detection decisions (accept, crop, reject, unavailable).")
+
+@contextmanager
+def cloud_call(service, operation):
+    """
+    Time one cloud call attempt and count it as ok or error.
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        metrics.observe("attendance_cloud_call_seconds", time.perf_counter() - started,
+                        service=service, operation=operation)
+        metrics.inc("attendance_cloud_calls_total", service=service, operation=operation, outcome=outcome)
+
+class LazyClient:
+    """
+    Proxy that builds its client on first use instead of at import, so the
+    module imports without credentials or network calls. The client is built
+    once per process: a forked worker builds its own rather than reusing the
+    parent's connections. The build time is recorded in startup_timings.
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self):
+        return self._pid == os.getpid()
+
+    def get(self):
+        if not self.initialized:
+            with self._lock:
+                if not self.initialized:
+                    started = time.perf_counter()
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+                    startup_timings[f"{self.name}_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return self._client
+
+    def set(self, client):
+        """
+        Use `client` in this process instead of building one (e.g. local fakes in benchmarks).
+        """
+        with self._lock:
+            self._client = client
+            self._pid = os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+# Client-side Rekognition throttling and retries
+REKOGNITION_TPS = float(os.getenv("REKOGNITION_TPS", "50"))                       # Calls/second per operation (account quota); 0 disables
+REKOGNITION_MAX_ATTEMPTS = int(os.getenv("REKOGNITION_MAX_ATTEMPTS", "5"))        # Tries per call, including the first
+REKOGNITION_BACKOFF_BASE = float(os.getenv("REKOGNITION_BACKOFF_BASE", "0.1"))    # Seconds; doubled per retry, with full jitter
+REKOGNITION_BACKOFF_MAX = float(os.getenv("REKOGNITION_BACKOFF_MAX", "5"))        # Seconds
+REKOGNITION_MAX_CONNECTIONS = int(os.getenv("REKOGNITION_MAX_CONNECTIONS", "50"))  # HTTP connection pool size
+
+class RekognitionClient:
+    """
+    Wraps the boto3 Rekognition client. detect_faces, search_faces_by_image and
+    index_faces each go through their own token bucket (REKOGNITION_TPS) and are
+    retried with exponential backoff and full jitter on throttling, server and
+    connection errors. A throttle halves that operation's rate, which then recovers by 5%
+    of REKOGNITION_TPS per successful call. TIMED_OPERATIONS are only timed and
+    counted; other methods pass straight through.
+    """
+    LIMITED_OPERATIONS = ("detect_faces", "search_faces_by_image", "index_faces")
+    TIMED_OPERATIONS = ("list_faces",)
+    THROTTLE_ERRORS = {"ThrottlingException", "ProvisionedThroughputExceededException"}
+    RETRYABLE_ERRORS = THROTTLE_ERRORS | {"InternalServerError", "ServiceUnavailableException"}
+
+    def __init__(self, client, tps, max_attempts, backoff_base, backoff_max):
+        self._client = client
+        self.tps = tps
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._limiters = {op: RateLimiter(tps, burst=max(1, int(tps))) for op in self.LIMITED_OPERATIONS}
+        self._counters = {op: Counter() for op in self.LIMITED_OPERATIONS}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name in self.LIMITED_OPERATIONS:
+            return functools.partial(self._call, name)
+        if name in self.TIMED_OPERATIONS:
+            return functools.partial(self._timed_call, name)
+        return getattr(self._client, name)
+
+    def _timed_call(self, operation, **kwargs):
+        with cloud_call("rekognition", operation):
+            return getattr(self._client, operation)(**kwargs)
+
+    def _count(self, operation, key):
+        with self._lock:
+            self._counters[operation][key] += 1
+
+    def _adjust_rate(self, operation, throttled):
+        limiter = self._limiters[operation]
+        with limiter._lock:
+            if throttled:
+                limiter.rate = max(self.tps * 0.1, limiter.rate / 2)
+            else:
+                limiter.rate = min(self.tps, limiter.rate + self.tps * 0.05)
+
+    def _call(self, operation, **kwargs):
+        method = getattr(self._client, operation)
+        limiter = self._limiters[operation]
+        self._count(operation, "calls")
+        for attempt in range(self.max_attempts):
+            limiter.acquire()
+            try:
+                with cloud_call("rekognition", operation):
+                    response = method(**kwargs)
+            except (ClientError, HTTPClientError, BotocoreConnectionError) as e:
+                code = e.response["Error"]["Code"] if isinstance(e, ClientError) else None
+                throttled = code in self.THROTTLE_ERRORS
+                if throttled:
+                    self._count(operation, "throttles")
+                    if self.tps > 0:
+                        self._adjust_rate(operation, throttled=True)
+                # Connection failures (reset, read or connect timeout, unreachable
+                # endpoint or proxy) have no code and are retried too
+                retryable = code is None or code in self.RETRYABLE_ERRORS
+                if not retryable or attempt + 1 >= self.max_attempts:
+                    self._count(operation, "errors")
+                    raise
+                self._count(operation, "retries")
+                metrics.inc("attendance_cloud_retries_total", service="rekognition", operation=operation)
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+                continue
+            if self.tps > 0 and limiter.rate < self.tps:
+                self._adjust_rate(operation, throttled=False)
+            return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                op: {
+                    "calls": counts["calls"],
+                    "throttles": counts["throttles"],
+                    "retries": counts["retries"],
+                    "errors": counts["errors"],
+                    "rate": round(self._limiters[op].rate, 2)
+                }
+                for op, counts in self._counters.items()
+            }
 
-def create_collection_if_not_exists(collection_id):
+def create_collection_if_not_exists(client, collection_id):
     try:
-        rekognition_client.create_collection(CollectionId=collection_id)
+        client.create_collection(CollectionId=collection_id)
         print(f"Collection '{collection_id}' created.")
-    except rekognition_client.exceptions.ResourceAlreadyExistsException:
+    except client.exceptions.ResourceAlreadyExistsException:
         print(f"Collection '{collection_id}' already exists.")
 
-create_collection_if_not_exists(COLLECTION_ID)
+def build_rekognition_client():
+    # Retries are done by RekognitionClient, so botocore makes a single attempt
+    client = boto3.client(
+        'rekognition',
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=AWS_REGION,
+        config=Config(
+            max_pool_connections=REKOGNITION_MAX_CONNECTIONS,
+            retries={"mode": "standard", "total_max_attempts": 1}
+        )
+    )
+    create_collection_if_not_exists(client, COLLECTION_ID)
+    return client
+
+rekognition_client = RekognitionClient(
+    LazyClient("rekognition", build_rekognition_client),
+    tps=REKOGNITION_TPS,
+    max_attempts=REKOGNITION_MAX_ATTEMPTS,
+    backoff_base=REKOGNITION_BACKOFF_BASE,
+    backoff_max=REKOGNITION_BACKOFF_MAX
+)
 
 # -----------------------------
 # 2) Firebase Firestore Setup
 # -----------------------------
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import FailedPrecondition
+
+def build_firestore_client():
+    base64_cred_str = os.environ.get("FIREBASE_ADMIN_CREDENTIALS_BASE64")
+    if not base64_cred_str:
+        raise ValueError("FIREBASE_ADMIN_CREDENTIALS_BASE64 not found in environment.")
+
+    decoded_cred_json = base64.b64decode(base64_cred_str)
+    cred_dict = json.loads(decoded_cred_json)
+    cred = credentials.Certificate(cred_dict)
+    # One Firebase app per process, so a forked worker gets its own Firestore client
+    firebase_app = firebase_admin.initialize_app(cred, name=f"attendance-{os.getpid()}")
+    return firestore.client(firebase_app)
+
+db = LazyClient("firestore", build_firestore_client)
+
+# Subjects cache: TTL in seconds, and optionally keep it warm with a snapshot listener
+SUBJECTS_CACHE_TTL = float(os.getenv("SUBJECTS_CACHE_TTL", "300"))
+SUBJECTS_LISTENER = os.getenv("SUBJECTS_LISTENER", "0") == "1"
+
+# Firestore allows at most 500 writes per WriteBatch
+FIRESTORE_BATCH_LIMIT = 500
+
+def commit_batched_writes(writes):
+    """
+    Commit a list of (doc_ref, data, merge) writes with WriteBatch,
+    splitting into chunks of FIRESTORE_BATCH_LIMIT. A data of None deletes the document.
+    A failing chunk does not stop the remaining chunks.
+    Returns (written_count, failures) where failures is a list of
+    (write_index, error_message) for every write in a failed chunk.
+    """
+    written = 0
+    failures = []
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        chunk = writes[start:start + FIRESTORE_BATCH_LIMIT]
+        batch = db.batch()
+        for doc_ref, data, merge in chunk:
+            if data is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, data, merge=merge)
+        try:
+            with cloud_call("firestore", "commit"):
+                batch.commit()
+        except Exception as e:
+            failures.extend((start + i, str(e)) for i in range(len(chunk)))
+        else:
+            written += len(chunk)
+    return written, failures
 
-base64_cred_str = os.environ.get("FIREBASE_ADMIN_CREDENTIALS_BASE64")
-if not base64_cred_str:
-    raise ValueError("FIREBASE_ADMIN_CREDENTIALS_BASE64 not found in environment.")
+def stream_documents(query):
+    """
+    Iterate a query's documents, timed and counted as one Firestore call.
+    Documents arrive as they are consumed, so the time includes the
+    caller's work between them.
+    """
+    with cloud_call("firestore", "query"):
+        yield from query.stream()
 
-decoded_cred_json = base64.b64decode(base64_cred_str)
-cred_dict = json.loads(decoded_cred_json)
-cred = credentials.Certificate(cred_dict)
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+def get_document(doc_ref):
+    with cloud_call("firestore", "get"):
+        return doc_ref.get()
 
 # -----------------------------
 # 3) Gemini Chatbot Setup
 # -----------------------------
-import google.generativeai as genai
-
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set.")
 
-genai.configure(api_key=GEMINI_API_KEY)
-# If you do NOT have access to "gemini-1.5-flash", switch to "models/chat-bison-001"
-model = genai.GenerativeModel("models/gemini-1.5-flash")
+def build_gemini_model():
+    # Imported here: the SDK alone takes about a second to import
+    import google.generativeai as genai
+
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY environment variable not set.")
+
+    genai.configure(api_key=GEMINI_API_KEY)
+    # If you do NOT have access to "gemini-1.5-flash", switch to "models/chat-bison-001"
+    return genai.GenerativeModel("models/gemini-1.5-flash")
+
+model = LazyClient("gemini", build_gemini_model)
+
+# Chat memory, kept per session
+MAX_MEMORY = 20                                                      # Messages kept per session
+CHAT_TOKEN_BUDGET = int(os.getenv("CHAT_TOKEN_BUDGET", "4000"))      # Approximate history tokens kept per session
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "1000"))      # Least recently used sessions are dropped beyond this
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", "3600"))      # Seconds an idle session is kept
 
-# Chat memory
-MAX_MEMORY = 20
-conversation_memory = []
+# Chat response cache, keyed by the normalized prompt
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "512"))           # 0 disables caching generated replies
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "86400"))         # Seconds
+CHAT_FAQ_FILE = os.getenv("CHAT_FAQ_FILE")                           # JSON {"question": "answer"} of pre-seeded answers
 
 # A big system prompt describing the entire system
 system_context = """You are Gemini, a somewhat witty (but polite) AI assistant.
@@ -94,34 +506,1430 @@ Facial Recognition Attendance system features:
    - You are the assistant, a bit humorous, guiding usage or code features.
 """
 
-# Start the conversation with a system message
-conversation_memory.append({"role": "system", "content": system_context})
+# Every prompt starts with the system message
+SYSTEM_PROMPT = f"System: {system_context}\n"
 
 # -----------------------------
 # 4) Flask App
 # -----------------------------
+class UploadRequest(Request):
+    """
+    Request class allowing a larger body for bulk enrollment uploads.
+    """
+    @property
+    def max_content_length(self):
+        if self.endpoint == "register_bulk":
+            return int(BULK_MAX_UPLOAD_MB * 1024 * 1024)
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+
+# Largest accepted request body (uploads above this get a 413 response)
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "16"))
+app.config["MAX_CONTENT_LENGTH"] = int(MAX_UPLOAD_MB * 1024 * 1024)
 
 # -----------------------------
-# 5) Image Enhancement Function (Using OpenCV and Pillow)
+# 5) Image Pipeline (decode once, enhance in place, crop from array)
 # -----------------------------
-def enhance_image(pil_image):
+JPEG_QUALITY = 75  # Same default quality Pillow used when saving JPEGs
+
+# Images are decoded no larger than needed: Rekognition needs faces of about
+# MIN_FACE_PX pixels, and the smallest face we care about spans
+# MIN_FACE_FRACTION of the photo's long edge (0.02 = a face in a ~50-wide row).
+MIN_FACE_PX = int(os.getenv("MIN_FACE_PX", "40"))
+MIN_FACE_FRACTION = float(os.getenv("MIN_FACE_FRACTION", "0.02"))
+MAX_LONG_EDGE = int(math.ceil(MIN_FACE_PX / MIN_FACE_FRACTION))
+
+# Brightness/contrast enhancement: v -> alpha * v + beta
+ENHANCE_ALPHA = float(os.getenv("ENHANCE_ALPHA", "1.2"))  # Contrast control (1.0-3.0)
+ENHANCE_BETA = float(os.getenv("ENHANCE_BETA", "30"))     # Brightness control (0-100)
+
+REKOGNITION_MAX_BYTES = 5 * 1024 * 1024  # Limit for Image={'Bytes': ...}
+REKOGNITION_JPEG_QUALITIES = (95, 85, 75, 60, 45)
+
+# JPEG DCT scaling: decode directly at 1/8, 1/4 or 1/2 resolution
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+def decode_image(image_bytes, max_long_edge=MAX_LONG_EDGE):
+    """
+    Decode image bytes once into an OpenCV (BGR) NumPy array, with EXIF
+    orientation applied and the long edge capped at max_long_edge (0 = no cap).
+    JPEGs are decoded at the smallest DCT scale that still covers the cap,
+    so a 48 MP photo is never materialised at full resolution. Pillow reports
+    JPEGs with extra MPF frames (gain maps, depth) from phones as MPO; the
+    first frame is a plain JPEG, so they are decoded the same way.
+    Returns None if the bytes are not a valid image.
+    """
+    # Only the header is parsed here, to learn the format and dimensions
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as probe:
+            image_format = probe.format
+            original_size = probe.size
+    except Exception:
+        image_format, original_size = None, None
+
+    flag = cv2.IMREAD_COLOR
+    if image_format in ("JPEG", "MPO") and max_long_edge:
+        for scale, reduced_flag in REDUCED_DECODE_FLAGS:
+            if max(original_size) // scale >= max_long_edge:
+                flag = reduced_flag
+                break
+
+    cv_image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flag)
+    if cv_image is None:
+        return None
+
+    height, width = cv_image.shape[:2]
+    if max_long_edge and max(height, width) > max_long_edge:
+        factor = max_long_edge / max(height, width)
+        cv_image = cv2.resize(
+            cv_image,
+            (max(1, round(width * factor)), max(1, round(height * factor))),
+            interpolation=cv2.INTER_AREA
+        )
+
+    if original_size:
+        app.logger.info(
+            "Decoded %dx%d image at %dx%d (%.1f%% of the pixels)",
+            original_size[0], original_size[1], cv_image.shape[1], cv_image.shape[0],
+            100.0 * cv_image.shape[0] * cv_image.shape[1] / (original_size[0] * original_size[1])
+        )
+    return cv_image
+
+def encode_jpeg(image_array, quality=JPEG_QUALITY):
+    """
+    Encode an OpenCV (BGR) array, or a view of one, to JPEG bytes.
+    """
+    ok, buffer = cv2.imencode('.jpg', image_array, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Failed to encode image as JPEG")
+    return buffer.tobytes()
+
+def encode_for_rekognition(cv_image, original_bytes=0, max_bytes=REKOGNITION_MAX_BYTES):
+    """
+    Encode at the highest JPEG quality in REKOGNITION_JPEG_QUALITIES that fits
+    max_bytes, downscaling further if even the lowest quality is too large.
+    """
+    while True:
+        for quality in REKOGNITION_JPEG_QUALITIES:
+            encoded = encode_jpeg(cv_image, quality)
+            if len(encoded) <= max_bytes:
+                if original_bytes:
+                    app.logger.info(
+                        "Encoded image for Rekognition at quality %d: %d -> %d bytes",
+                        quality, original_bytes, len(encoded)
+                    )
+                return encoded
+        height, width = cv_image.shape[:2]
+        cv_image = cv2.resize(cv_image, (max(1, width * 3 // 4), max(1, height * 3 // 4)), interpolation=cv2.INTER_AREA)
+
+@functools.lru_cache(maxsize=16)
+def enhance_lut(alpha, beta):
+    """
+    256-entry lookup table for the per-pixel map saturate(|alpha * v + beta|),
+    i.e. exactly what cv2.convertScaleAbs computes.
+    """
+    values = np.abs(np.arange(256, dtype=np.float64) * alpha + beta)
+    return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+def enhance_image(cv_image, alpha=ENHANCE_ALPHA, beta=ENHANCE_BETA, in_place=True):
     """
     Enhance image quality to improve face detection in distant group photos.
     This includes increasing brightness and contrast.
+    The map is per pixel and per channel, so it is applied as a lookup table
+    directly to the decoded buffer, in place unless in_place=False.
+    """
+    lut = enhance_lut(float(alpha), float(beta))
+    if in_place:
+        cv2.LUT(cv_image, lut, dst=cv_image)
+        return cv_image
+    return cv2.LUT(cv_image, lut)
+
+def crop_face(cv_image, bbox):
+    """
+    Return the face region described by a Rekognition BoundingBox
+    (coordinates relative to image dimensions) as a view into cv_image.
+    """
+    img_height, img_width = cv_image.shape[:2]
+
+    left = int(bbox['Left'] * img_width)
+    top = int(bbox['Top'] * img_height)
+    width = int(bbox['Width'] * img_width)
+    height = int(bbox['Height'] * img_height)
+
+    # Bounding boxes may extend past the image edges
+    left = min(max(left, 0), img_width - 1)
+    top = min(max(top, 0), img_height - 1)
+    right = min(max(left + width, left + 1), img_width)
+    bottom = min(max(top + height, top + 1), img_height)
+
+    return cv_image[top:bottom, left:right]
+
+# -----------------------------
+# 5b) Caches
+# -----------------------------
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+    Keeps hit/miss counters for reporting.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def _find(self, key, now):
+        return key if key in self._data else None
+
+    def get(self, key):
+        with self._lock:
+            now = time.monotonic()
+            found = self._find(key, now)
+            if found is not None:
+                expires_at, value = self._data[found]
+                if expires_at > now:
+                    self._data.move_to_end(found)
+                    self.hits += 1
+                    return value
+                del self._data[found]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key, value):
+        """
+        Insert without evicting: expired entries are dropped first, and
+        False is returned if the cache is still full.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for expired in [k for k, (expires_at, _) in self._data.items() if expires_at <= now]:
+                del self._data[expired]
+            if len(self._data) >= self.maxsize:
+                return False
+            self._data[key] = (now + self.ttl, value)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+class PerceptualHashCache(TTLCache):
+    """
+    TTLCache keyed by 64-bit perceptual hashes. A lookup hits the closest
+    stored hash within `max_distance` bits (Hamming distance).
+    """
+    def __init__(self, maxsize, ttl, max_distance):
+        super().__init__(maxsize, ttl)
+        self.max_distance = max_distance
+
+    def _find(self, key, now):
+        if key in self._data:
+            return key
+        if self.max_distance <= 0:
+            return None
+        best_key, best_distance = None, self.max_distance + 1
+        for stored_key, (expires_at, _) in self._data.items():
+            if expires_at <= now:
+                continue
+            distance = bin(stored_key ^ key).count("1")
+            if distance < best_distance:
+                best_key, best_distance = stored_key, distance
+        return best_key
+
+    def stats(self):
+        out = super().stats()
+        out["max_distance"] = self.max_distance
+        return out
+
+face_search_cache = PerceptualHashCache(FACE_CACHE_SIZE, FACE_CACHE_TTL, FACE_CACHE_MAX_DISTANCE)
+
+def face_hash(face_crop):
+    """
+    64-bit perceptual hash (pHash) of a face crop.
+    The crop is normalized to a 32x32 equalized grayscale image first, so
+    the same face photographed again hashes to the same or a nearby value.
+    """
+    gray = cv2.cvtColor(face_crop, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+    small = cv2.equalizeHist(small).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8]
+    bits = (low_freq > np.median(low_freq)).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+# -----------------------------
+# 5c) Face Search Helpers
+# -----------------------------
+def search_face(idx, face_crop, endpoint="recognize"):
+    """
+    Search a single face crop (a view of the decoded image) in the
+    Rekognition collection, using the perceptual-hash cache when possible.
+    Returns the entry to report for this face in identified_people.
+    endpoint labels the encode stage timing.
+    """
+    key = face_hash(face_crop) if FACE_CACHE_SIZE > 0 else None
+    if key is not None:
+        cached = face_search_cache.get(key)
+        if cached is not None:
+            return dict(cached)
+
+    with metrics.time("attendance_stage_seconds", endpoint=endpoint, stage="encode"):
+        cropped_face_bytes = encode_jpeg(face_crop)
+    try:
+        search_response = rekognition_client.search_faces_by_image(
+            CollectionId=COLLECTION_ID,
+            Image={'Bytes': cropped_face_bytes},
+            MaxFaces=1,
+            FaceMatchThreshold=60
+        )
+    except Exception as e:
+        return {
+            "message": f"Error searching face {idx+1}: {str(e)}",
+            "error": str(e),
+            "confidence": "N/A"
+        }
+
+    matches = search_response.get('FaceMatches', [])
+    if not matches:
+        result = {
+            "message": "Face not recognized",
+            "confidence": "N/A"
+        }
+        # A student enrolled through another worker process would stay "not
+        # recognized" here until the entry expired, so misses expire quickly
+        if key is not None and FACE_CACHE_NEGATIVE_TTL > 0:
+            face_search_cache.put(key, result, ttl=FACE_CACHE_NEGATIVE_TTL)
+        return dict(result)
+
+    match = matches[0]
+    ext_id = match['Face']['ExternalImageId']
+    confidence = match['Face']['Confidence']
+
+    parts = ext_id.split("_", 1)
+    if len(parts) == 2:
+        rec_name, rec_id = parts
+    else:
+        rec_name, rec_id = ext_id, "Unknown"
+
+    result = {
+        "name": rec_name,
+        "student_id": rec_id,
+        "confidence": confidence
+    }
+    if key is not None:
+        face_search_cache.put(key, result)
+    return dict(result)
+
+def search_faces(face_crops, on_searched=None, endpoint="recognize"):
+    """
+    Search all face crops concurrently, at most SEARCH_MAX_WORKERS at a time.
+    Results are returned in the same order as face_crops.
+    on_searched, if given, is called (from the worker threads) after each search.
+    """
+    if not face_crops:
+        return []
+
+    def search(idx, face_crop):
+        result = search_face(idx, face_crop, endpoint)
+        if on_searched:
+            on_searched()
+        return result
+
+    max_workers = max(1, min(SEARCH_MAX_WORKERS, len(face_crops)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(search, range(len(face_crops)), face_crops))
+
+# -----------------------------
+# 5d) Face Detection (full frame or overlapping tiles)
+# -----------------------------
+def detect_faces_full(cv_image, image_bytes_size=0, endpoint="recognize"):
+    """
+    Run detect_faces once on the whole (enhanced) frame.
+    """
+    with metrics.time("attendance_stage_seconds", endpoint=endpoint, stage="encode"):
+        image_bytes = encode_for_rekognition(cv_image, image_bytes_size)
+    detect_response = rekognition_client.detect_faces(
+        Image={'Bytes': image_bytes},
+        Attributes=['ALL']
+    )
+    return detect_response.get('FaceDetails', [])
+
+def region_faces_to_image(faces, box, img_width, img_height):
+    """
+    Map faces detected in the pixel region `box` (left, top, right, bottom)
+    to BoundingBoxes relative to the whole image.
+    """
+    left, top, right, bottom = box
+    region_width, region_height = right - left, bottom - top
+    mapped = []
+    for face in faces:
+        bbox = face['BoundingBox']
+        face = dict(face)
+        face['BoundingBox'] = {
+            'Left': (left + bbox['Left'] * region_width) / img_width,
+            'Top': (top + bbox['Top'] * region_height) / img_height,
+            'Width': bbox['Width'] * region_width / img_width,
+            'Height': bbox['Height'] * region_height / img_height
+        }
+        mapped.append(face)
+    return mapped
+
+def tile_boxes(width, height, grid, overlap):
+    """
+    Pixel boxes (left, top, right, bottom) of a grid x grid tiling in which
+    neighbouring tiles share `overlap` of a tile, so a face cut by one tile
+    border lies whole inside a neighbouring tile.
+    """
+    def spans(length):
+        tile = length / (grid - (grid - 1) * overlap)
+        step = tile * (1 - overlap)
+        return [(int(round(i * step)), min(length, int(round(i * step + tile)))) for i in range(grid)]
+
+    return [
+        (left, top, right, bottom)
+        for top, bottom in spans(height)
+        for left, right in spans(width)
+    ]
+
+def box_overlap(a, b):
+    """
+    Intersection over the smaller box of two Rekognition BoundingBoxes.
+    Unlike IoU this is close to 1 when a face truncated at a tile border
+    overlaps the whole face detected in the neighbouring tile.
+    """
+    inter_w = min(a['Left'] + a['Width'], b['Left'] + b['Width']) - max(a['Left'], b['Left'])
+    inter_h = min(a['Top'] + a['Height'], b['Top'] + b['Height']) - max(a['Top'], b['Top'])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    smaller = min(a['Width'] * a['Height'], b['Width'] * b['Height'])
+    return (inter_w * inter_h) / smaller if smaller > 0 else 0.0
+
+def merge_duplicate_faces(faces, threshold=TILE_DUPLICATE_OVERLAP):
+    """
+    Non-maximum suppression: keep the largest detection of every group of
+    overlapping boxes (the most confident one on a tie). A face cut by a tile
+    border can score higher than the whole face from the neighbouring tile,
+    but only the whole box gives a usable crop.
+    """
+    def rank(face):
+        box = face['BoundingBox']
+        return (box['Width'] * box['Height'], face.get('Confidence', 0))
+
+    kept = []
+    for face in sorted(faces, key=rank, reverse=True):
+        if all(box_overlap(face['BoundingBox'], k['BoundingBox']) < threshold for k in kept):
+            kept.append(face)
+    # Report faces in reading order, like a full-frame detection
+    kept.sort(key=lambda f: (f['BoundingBox']['Top'], f['BoundingBox']['Left']))
+    return kept
+
+def detect_faces_tiled(cv_image, grid=TILE_GRID, overlap=TILE_OVERLAP):
+    """
+    Run detect_faces concurrently on overlapping tiles, map the boxes back to
+    coordinates relative to the whole image and merge duplicates.
+    Raises the first tile's error if any tile fails.
+    """
+    img_height, img_width = cv_image.shape[:2]
+    boxes = tile_boxes(img_width, img_height, grid, overlap)
+
+    def detect_tile(box):
+        left, top, right, bottom = box
+        with metrics.time("attendance_stage_seconds", endpoint="recognize", stage="encode"):
+            tile_bytes = encode_for_rekognition(cv_image[top:bottom, left:right])
+        response = rekognition_client.detect_faces(
+            Image={'Bytes': tile_bytes},
+            Attributes=['ALL']
+        )
+        return region_faces_to_image(response.get('FaceDetails', []), box, img_width, img_height)
+
+    max_workers = max(1, min(TILE_MAX_WORKERS, len(boxes)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tile_faces = list(executor.map(detect_tile, boxes))
+
+    return merge_duplicate_faces([face for faces in tile_faces for face in faces])
+
+# Local pre-detection: an OpenCV cascade finds candidate faces offline, so a
+# photo without any is answered without calling detect_faces, and in crop mode
+# only the region around the candidates is uploaded. Cascades miss some faces
+# (profiles, heavy blur) that Rekognition finds, so the mode is opt-in.
+_predetect_local = threading.local()
+
+def predetect_cascade():
+    """
+    This thread's cascade classifier (CascadeClassifier is not thread-safe),
+    or None if OpenCV has no cascade support or the file does not load.
+    """
+    if not hasattr(_predetect_local, "cascade"):
+        cascade = None
+        if hasattr(cv2, "CascadeClassifier"):
+            path = PREDETECT_CASCADE
+            if not os.path.isfile(path) and hasattr(cv2, "data"):
+                path = os.path.join(cv2.data.haarcascades, PREDETECT_CASCADE)
+            cascade = cv2.CascadeClassifier(path)
+            if cascade.empty():
+                cascade = None
+        if cascade is None:
+            app.logger.warning("Pre-detection cascade %s could not be loaded; pre-detection is skipped", PREDETECT_CASCADE)
+        _predetect_local.cascade = cascade
+    return _predetect_local.cascade
+
+def local_face_candidates(cv_image):
+    """
+    Candidate face boxes (left, top, right, bottom) in pixels of cv_image,
+    or None when no cascade is available. The search covers faces down to
+    MIN_FACE_FRACTION of the long edge.
+    """
+    cascade = predetect_cascade()
+    if cascade is None:
+        return None
+    img_height, img_width = cv_image.shape[:2]
+    # Downscale so the smallest face we care about just fills the cascade's window
+    window_w, window_h = cascade.getOriginalWindowSize()
+    scale = min(1.0, max(window_w, window_h) / (MIN_FACE_FRACTION * max(img_width, img_height)))
+    gray = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (max(1, round(img_width * scale)), max(1, round(img_height * scale))), interpolation=cv2.INTER_AREA)
+    gray = cv2.equalizeHist(gray)
+    found = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=PREDETECT_MIN_NEIGHBORS)
+    return [
+        (int(x / scale), int(y / scale), int((x + w) / scale), int((y + h) / scale))
+        for x, y, w, h in found
+    ]
+
+def candidate_region(candidates, img_width, img_height, margin=PREDETECT_CROP_MARGIN):
+    """
+    Union of the candidate boxes grown by `margin` of each box's size,
+    clipped to the image, as (left, top, right, bottom).
+    """
+    left = min(max(0, int(l - (r - l) * margin)) for l, t, r, b in candidates)
+    top = min(max(0, int(t - (b - t) * margin)) for l, t, r, b in candidates)
+    right = max(min(img_width, int(r + (r - l) * margin)) for l, t, r, b in candidates)
+    bottom = max(min(img_height, int(b + (b - t) * margin)) for l, t, r, b in candidates)
+    return left, top, right, bottom
+
+def detect_faces_predetected(cv_image, image_bytes_size=0, endpoint="recognize", mode=PREDETECT_MODE):
+    """
+    detect_faces_full behind the local pre-detection gate: returns [] without
+    calling Rekognition when the cascade finds no face, and in crop mode sends
+    only the region around the candidates. Decisions are counted in
+    attendance_predetect_total.
+    """
+    if mode not in ("gate", "crop"):
+        return detect_faces_full(cv_image, image_bytes_size, endpoint)
+
+    with metrics.time("attendance_stage_seconds", endpoint=endpoint, stage="predetect"):
+        candidates = local_face_candidates(cv_image)
+    if candidates is None:
+        metrics.inc("attendance_predetect_total", decision="unavailable")
+        return detect_faces_full(cv_image, image_bytes_size, endpoint)
+    if not candidates:
+        metrics.inc("attendance_predetect_total", decision="reject")
+        return []
+
+    img_height, img_width = cv_image.shape[:2]
+    box = candidate_region(candidates, img_width, img_height)
+    left, top, right, bottom = box
+    if mode != "crop" or (right - left) * (bottom - top) > PREDETECT_MAX_CROP_AREA * img_width * img_height:
+        metrics.inc("attendance_predetect_total", decision="accept")
+        return detect_faces_full(cv_image, image_bytes_size, endpoint)
+
+    metrics.inc("attendance_predetect_total", decision="crop")
+    faces = detect_faces_full(cv_image[top:bottom, left:right], image_bytes_size, endpoint)
+    return region_faces_to_image(faces, box, img_width, img_height)
+
+# -----------------------------
+# 5e) Subject Lookups (cached)
+# -----------------------------
+SUBJECTS_CACHE_KEY = "subjects"
+subjects_cache = TTLCache(1, SUBJECTS_CACHE_TTL)
+
+def get_all_subjects():
+    """
+    Return {subject_id: subject_name} for every subject, served from
+    subjects_cache and re-read from Firestore when it is empty or expired.
+    """
+    subjects = subjects_cache.get(SUBJECTS_CACHE_KEY)
+    if subjects is None:
+        subjects = {}
+        for s in stream_documents(db.collection("subjects")):
+            subjects[s.id] = s.to_dict().get("name", "")
+        subjects_cache.put(SUBJECTS_CACHE_KEY, subjects)
+    return subjects
+
+def get_subject_name(subject_id):
+    """
+    Look up a subject name by id, falling back to a direct document read
+    for subjects added by another worker since the cache was filled.
+    """
+    subjects = get_all_subjects()
+    if subject_id in subjects:
+        return subjects[subject_id]
+    sdoc = get_document(db.collection("subjects").document(subject_id))
+    if not sdoc.exists:
+        return "Unknown Subject"
+    subjects_cache.clear()
+    return sdoc.to_dict().get("name", "")
+
+def start_subjects_listener():
+    """
+    Keep subjects_cache warm from a Firestore snapshot listener so subject
+    changes show up at once. The entry keeps its SUBJECTS_CACHE_TTL as a
+    backstop: if the listener's stream dies, the cache falls back to
+    re-reading subjects once per TTL instead of staying stale.
+    """
+    def on_snapshot(col_snapshot, changes, read_time):
+        subjects_cache.put(
+            SUBJECTS_CACHE_KEY,
+            {doc.id: doc.to_dict().get("name", "") for doc in col_snapshot}
+        )
+
+    return db.collection("subjects").on_snapshot(on_snapshot)
+
+subjects_watch = None
+
+def start_subjects_listener_or_ttl():
+    """
+    Start the subjects listener (SUBJECTS_LISTENER=1); on failure keep the TTL cache.
+    """
+    global subjects_watch
+    try:
+        subjects_watch = start_subjects_listener()
+    except Exception as e:
+        print(f"Subjects listener not started, using TTL cache only: {e}")
+
+# -----------------------------
+# 5f) Attendance Aggregates
+# -----------------------------
+# Counters of PRESENT records, kept in sync with every attendance write:
+#   subject_day:     per (subject_id, day)
+#   student_subject: per (student_id, subject_id)
+AGGREGATES_COLLECTION = "attendance_aggregates"
+
+def aggregate_keys(record):
+    """
+    Return the (doc_id, kind, fields) aggregates an attendance record counts towards.
+    """
+    if str(record.get("status") or "").upper() != "PRESENT":
+        return []
+    student_id = str(record.get("student_id") or "")
+    subject_id = str(record.get("subject_id") or "")
+    day = str(record.get("timestamp") or "")[:10]
+
+    groups = [("subject_day", {"subject_id": subject_id, "day": day})]
+    if student_id:
+        groups.append(("student_subject", {"student_id": student_id, "subject_id": subject_id}))
+    return [
+        ("|".join([kind] + [quote(v, safe="") for v in fields.values()]), kind, fields)
+        for kind, fields in groups
+    ]
+
+def aggregate_writes(old_records, new_records):
+    """
+    Build the (doc_ref, data, merge) writes that move the aggregate counters
+    from old_records to new_records, to be committed with the record writes.
+    """
+    deltas = Counter()
+    groups = {}
+    for sign, records in ((-1, old_records), (1, new_records)):
+        for record in records:
+            for doc_id, kind, fields in aggregate_keys(record):
+                deltas[doc_id] += sign
+                groups[doc_id] = (kind, fields)
+
+    writes = []
+    for doc_id, delta in deltas.items():
+        if delta == 0:
+            continue
+        kind, fields = groups[doc_id]
+        data = {"kind": kind, **fields, "count": firestore.Increment(delta)}
+        writes.append((db.collection(AGGREGATES_COLLECTION).document(doc_id), data, True))
+    return writes
+
+# A record write moves at most two counters down (its old groups) and two up,
+# so this many records and all of their counter writes fit in one WriteBatch
+RECORDS_PER_BATCH = FIRESTORE_BATCH_LIMIT // 5
+
+def commit_attendance_writes(record_writes):
+    """
+    Commit (doc_ref, data, merge, old_record, new_record) attendance writes
+    together with the aggregate counter updates they cause (old_record is None
+    for a new document). Each batch holds up to RECORDS_PER_BATCH records and
+    all of their counter writes, so a record and its counters are committed,
+    or fail, together.
+    A doc written more than once starts each later write from the record the
+    previous committed write left, so its counters move once per change rather
+    than once per row.
+    Returns failures as a list of (record_index, error_message).
+    """
+    failures = []
+    committed = {}  # doc path -> record after the last committed write
+    for start in range(0, len(record_writes), RECORDS_PER_BATCH):
+        chunk = []
+        written = {}  # doc path -> record after the last write in this chunk
+        for ref, data, merge, old, new in record_writes[start:start + RECORDS_PER_BATCH]:
+            path = ref.path
+            if path in written or path in committed:
+                old = written[path] if path in written else committed[path]
+                new = {**old, **data} if merge else data
+            written[path] = new
+            chunk.append((ref, data, merge, old, new))
+
+        writes = [(ref, data, merge) for ref, data, merge, _, _ in chunk]
+        writes += aggregate_writes(
+            [old for _, _, _, old, _ in chunk if old is not None],
+            [new for _, _, _, _, new in chunk]
+        )
+        _, chunk_failures = commit_batched_writes(writes)
+        if chunk_failures:
+            error = chunk_failures[0][1]
+            failures.extend((start + i, error) for i in range(len(chunk)))
+        else:
+            committed.update(written)
+    return failures
+
+def existing_records(refs):
+    """
+    Read the current data of the given attendance refs in one round-trip.
+    Returns {doc_id: data} for the documents that exist.
+    """
+    if not refs:
+        return {}
+    with cloud_call("firestore", "get_all"):
+        return {snap.id: snap.to_dict() for snap in db.get_all(refs) if snap.exists}
+
+@app.cli.command("rebuild-aggregates")
+def rebuild_aggregates():
+    """
+    Recompute attendance_aggregates from scratch by streaming attendance.
+    Run with: flask --app app rebuild-aggregates (ideally while no
+    attendance is being written, as concurrent increments would be lost).
+    """
+    deletes = [(doc_.reference, None, False) for doc_ in stream_documents(db.collection(AGGREGATES_COLLECTION))]
+    _, failures = commit_batched_writes(deletes)
+    if failures:
+        print(f"Failed to clear {len(failures)} aggregate document(s); aborting.")
+        return
+
+    counts = Counter()
+    groups = {}
+    records = 0
+    for doc_ in stream_documents(db.collection("attendance")):
+        records += 1
+        for doc_id, kind, fields in aggregate_keys(doc_.to_dict()):
+            counts[doc_id] += 1
+            groups[doc_id] = (kind, fields)
+
+    writes = [
+        (db.collection(AGGREGATES_COLLECTION).document(doc_id), {"kind": groups[doc_id][0], **groups[doc_id][1], "count": count}, False)
+        for doc_id, count in counts.items()
+    ]
+    written, failures = commit_batched_writes(writes)
+    print(f"Rebuilt {written} aggregate(s) from {records} attendance record(s), {len(failures)} failed.")
+
+# -----------------------------
+# 5g) Registration and Recognition Pipelines
+# -----------------------------
+# Route-independent steps, shared by the Flask routes and the async (ASGI)
+# serving mode in asgi.py, which awaits each blocking step separately.
+def external_image_id_for(name, student_id):
+    """
+    ExternalImageId a student's face is indexed under ("<name>_<student_id>").
+    """
+    sanitized_name = "".join(c if c.isalnum() or c in "_-." else "_" for c in name)
+    return f"{sanitized_name}_{student_id}"
+
+def run_registration(data, image_bytes, rate_limiter=None):
+    """
+    Index one student's face: decode, enhance and send to index_faces.
+    Returns (payload, status) for the response.
+    """
+    name = data.get('name')
+    student_id = data.get('student_id')
+    if not name or not student_id or not image_bytes:
+        return {"message": "Missing name, student_id, or image"}, 400
+
+    # Enhance image before indexing
+    with metrics.time("attendance_stage_seconds", endpoint="register", stage="decode"):
+        cv_image = decode_image(image_bytes)
+    if cv_image is None:
+        return {"message": "Invalid image data"}, 400
+    with metrics.time("attendance_stage_seconds", endpoint="register", stage="enhance"):
+        enhance_image(cv_image)
+    with metrics.time("attendance_stage_seconds", endpoint="register", stage="encode"):
+        enhanced_image_bytes = encode_for_rekognition(cv_image, len(image_bytes))
+
+    external_image_id = external_image_id_for(name, student_id)
+    if rate_limiter:
+        rate_limiter.acquire()
+    try:
+        with metrics.time("attendance_stage_seconds", endpoint="register", stage="index_faces"):
+            response = rekognition_client.index_faces(
+                CollectionId=COLLECTION_ID,
+                Image={'Bytes': enhanced_image_bytes},
+                ExternalImageId=external_image_id,
+                DetectionAttributes=['ALL'],
+                QualityFilter='AUTO'
+            )
+    except Exception as e:
+        return {"message": f"Failed to index face: {str(e)}"}, 500
+
+    if not response.get('FaceRecords'):
+        return {"message": "No face detected in the image"}, 400
+
+    # The collection changed, so cached search results may be stale
+    face_search_cache.clear()
+
+    return {"message": f"Student {name} with ID {student_id} registered successfully!"}, 200
+
+def indexed_external_ids():
+    """
+    ExternalImageIds already in the collection (one paginated list_faces scan).
+    """
+    external_ids = set()
+    kwargs = {"CollectionId": COLLECTION_ID, "MaxResults": 4096}
+    while True:
+        response = rekognition_client.list_faces(**kwargs)
+        external_ids.update(f.get("ExternalImageId") for f in response.get("Faces", []))
+        if not response.get("NextToken"):
+            return external_ids
+        kwargs["NextToken"] = response["NextToken"]
+
+def run_bulk_registration(entries, resume=True):
+    """
+    Register many students. entries yields (name, student_id, read_image)
+    where read_image() returns the image bytes (or raises ValueError).
+    Images are read one at a time and at most 2 x BULK_MAX_WORKERS are held
+    in memory; decoding and index_faces run on BULK_MAX_WORKERS threads with
+    index_faces capped at BULK_INDEX_TPS calls per second. With resume,
+    students whose face is already indexed are skipped, so a partially
+    failed upload can simply be sent again.
+    Returns one result per entry, in order.
+    """
+    already_indexed = indexed_external_ids() if resume else set()
+    rate_limiter = RateLimiter(BULK_INDEX_TPS, burst=max(1, int(BULK_INDEX_TPS)))
+    results = []
+    pending = deque()  # (result, future)
+
+    def collect(result, future):
+        payload, status = future.result()
+        result["status"] = "registered" if status == 200 else "failed"
+        result["message"] = payload.get("message", "")
+
+    with ThreadPoolExecutor(max_workers=max(1, BULK_MAX_WORKERS)) as executor:
+        for name, student_id, read_image in entries:
+            result = {"name": name, "student_id": student_id}
+            results.append(result)
+            if not name or not student_id:
+                result.update(status="failed", message="Missing name or student_id")
+                continue
+            if external_image_id_for(name, student_id) in already_indexed:
+                result.update(status="skipped", message="Already registered")
+                continue
+            try:
+                image_bytes = read_image()
+            except ValueError as e:
+                result.update(status="failed", message=str(e))
+                continue
+
+            future = executor.submit(run_registration, {"name": name, "student_id": student_id}, image_bytes, rate_limiter)
+            pending.append((result, future))
+            if len(pending) >= 2 * BULK_MAX_WORKERS:
+                collect(*pending.popleft())
+
+        while pending:
+            collect(*pending.popleft())
+
+    return results
+
+def prepare_recognition(data, image_bytes):
+    """
+    Validate the recognition options and decode + enhance the image.
+    Returns (job, error): job holds the options and the decoded cv_image,
+    error is a (payload, status) tuple when the request is invalid.
+    """
+    if not image_bytes:
+        return None, ({"message": "No image provided"}, 400)
+
+    # Full-frame (default) or overlapping-tile detection for large group photos
+    detection_mode = data.get('detection_mode') or "full"
+    if detection_mode not in ("full", "tiled"):
+        return None, ({"message": "detection_mode must be 'full' or 'tiled'"}, 400)
+    try:
+        grid = int(data.get('tile_grid') or TILE_GRID)
+        overlap = float(data.get('tile_overlap') or TILE_OVERLAP)
+    except ValueError:
+        return None, ({"message": "tile_grid must be an integer and tile_overlap a number"}, 400)
+    if not 1 <= grid <= 6 or not 0 <= overlap < 1:
+        return None, ({"message": "tile_grid must be 1-6 and tile_overlap in [0, 1)"}, 400)
+
+    # Decode once and enhance in place; faces are cropped from this array.
+    # Tiled mode keeps more resolution so each tile still has enough pixels.
+    max_long_edge = MAX_LONG_EDGE * grid if detection_mode == "tiled" else MAX_LONG_EDGE
+    with metrics.time("attendance_stage_seconds", endpoint="recognize", stage="decode"):
+        cv_image = decode_image(image_bytes, max_long_edge)
+    if cv_image is None:
+        return None, ({"message": "Invalid image data"}, 400)
+    with metrics.time("attendance_stage_seconds", endpoint="recognize", stage="enhance"):
+        enhance_image(cv_image)
+
+    job = {
+        "subject_id": data.get('subject_id') or "",
+        "attendance_session": str(data.get('attendance_session') or "").strip(),
+        "detection_mode": detection_mode,
+        "grid": grid,
+        "overlap": overlap,
+        "cv_image": cv_image,
+        "image_size": len(image_bytes)
+    }
+    return job, None
+
+def detect_job_faces(job):
+    """
+    Detect faces for a prepared recognition job (raises on Rekognition errors).
+    """
+    with metrics.time("attendance_stage_seconds", endpoint="recognize", stage="detect"):
+        if job["detection_mode"] == "tiled":
+            faces = detect_faces_tiled(job["cv_image"], job["grid"], job["overlap"])
+        else:
+            faces = detect_faces_predetected(job["cv_image"], job["image_size"])
+    metrics.observe("attendance_faces_per_request", len(faces))
+    return faces
+
+def crop_job_faces(job, faces):
+    """
+    Crop each face as a view of the decoded array; crops are encoded only
+    once, and only when the search cache misses.
+    """
+    with metrics.time("attendance_stage_seconds", endpoint="recognize", stage="crop"):
+        return [crop_face(job["cv_image"], face['BoundingBox']) for face in faces]
+
+# A student is recorded once per subject per window (1440 = one UTC day),
+# or once per attendance_session when the request names one
+ATTENDANCE_WINDOW_MINUTES = int(os.getenv("ATTENDANCE_WINDOW_MINUTES", "1440"))
+
+def attendance_window(now):
+    """
+    Start of the ATTENDANCE_WINDOW_MINUTES window containing `now` (naive UTC),
+    e.g. "2024-05-01T00:00" for daily windows.
+    """
+    window = max(1, ATTENDANCE_WINDOW_MINUTES) * 60
+    seconds = int((now - datetime(1970, 1, 1)).total_seconds())
+    return datetime.utcfromtimestamp(seconds - seconds % window).isoformat(timespec="minutes")
+
+def attendance_doc_id(student_id, subject_id, session):
+    """
+    Deterministic attendance document id, so logging the same student twice
+    in one session updates one document instead of adding another.
+    """
+    return "|".join(quote(str(value), safe="") for value in (student_id, subject_id, session))
+
+def log_attendance(job, identified_people):
+    """
+    Upsert attendance for every recognized face in transactions of up to
+    RECORDS_PER_BATCH records. Records are keyed by (student, subject, session
+    or window) and written with merge, so re-submitted or overlapping photos add
+    no rows; a re-logged record keeps its first timestamp and unchanged records
+    are not written at all.
+    Returns the attendance_log reported to the client.
     """
-    # Convert PIL image to OpenCV format
-    cv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+    with metrics.time("attendance_stage_seconds", endpoint="recognize", stage="log_attendance"):
+        return _log_attendance(job, identified_people)
 
-    # Increase brightness and contrast
-    alpha = 1.2  # Contrast control (1.0-3.0)
-    beta = 30    # Brightness control (0-100)
-    enhanced_cv_image = cv2.convertScaleAbs(cv_image, alpha=alpha, beta=beta)
+def _log_attendance(job, identified_people):
+    subject_id = job["subject_id"]
+    # Optionally fetch subject name
+    subject_name = get_subject_name(subject_id) if subject_id else ""
+
+    now = datetime.utcnow()
+    timestamp = now.isoformat()
+    session = job.get("attendance_session") or attendance_window(now)
+    records = {}
+    for person in identified_people:
+        rec_id = person.get("student_id")
+        # If recognized, log attendance (once, even if matched by several faces)
+        if rec_id and rec_id != "Unknown":
+            doc_id = attendance_doc_id(rec_id, subject_id, session)
+            records.setdefault(doc_id, (person, {
+                "student_id": rec_id,
+                "name": person["name"],
+                "timestamp": timestamp,
+                "subject_id": subject_id,
+                "subject_name": subject_name,
+                "status": "PRESENT",
+                "session": session
+            }))
+
+    items = list(records.items())
+    failed_people = []
+    for start in range(0, len(items), RECORDS_PER_BATCH):
+        chunk = items[start:start + RECORDS_PER_BATCH]
+        try:
+            with cloud_call("firestore", "transaction"):
+                upsert_attendance(db.transaction(), chunk, timestamp)
+        except Exception as e:
+            failed_people.extend(
+                {"name": person["name"], "student_id": person["student_id"], "error": str(e)}
+                for _, (person, _) in chunk
+            )
+    return {
+        "logged": len(records) - len(failed_people),
+        "failed": failed_people
+    }
 
-    # Convert back to PIL Image
-    enhanced_pil_image = Image.fromarray(cv2.cvtColor(enhanced_cv_image, cv2.COLOR_BGR2RGB))
+@firestore.transactional
+def upsert_attendance(transaction, records, timestamp):
+    """
+    Read the existing docs of `records` ([(doc_id, (person, doc))]) and write
+    the new or changed ones with their counter updates, all in one transaction.
+    Two concurrent uploads of the same photo therefore cannot both see a record
+    as new and both count it; Firestore re-runs this on contention.
+    """
+    refs = {doc_id: db.collection("attendance").document(doc_id) for doc_id, _ in records}
+    existing = {snap.id: snap.to_dict() for snap in transaction.get_all(list(refs.values())) if snap.exists}
+    writes = []
+    for doc_id, (person, doc) in records:
+        old = existing.get(doc_id)
+        if old is not None:
+            # A copy, so a retried attempt starts from the request's record
+            doc = {**doc, "timestamp": old.get("timestamp") or timestamp}
+            if all(old.get(field) == value for field, value in doc.items()):
+                continue
+        writes.append((refs[doc_id], doc, old))
+
+    for doc_ref, doc, _ in writes:
+        transaction.set(doc_ref, doc, merge=True)
+    old_records = [old for _, _, old in writes if old is not None]
+    for doc_ref, data, merge in aggregate_writes(old_records, [doc for _, doc, _ in writes]):
+        transaction.set(doc_ref, data, merge=merge)
+
+def recognition_payload(job, faces, identified_people=None, attendance_log=None):
+    """
+    Response body for a finished recognition.
+    """
+    face_count = len(faces)
+    if face_count == 0:
+        return {
+            "message": "No faces detected in the image.",
+            "total_faces": face_count,
+            "identified_people": []
+        }
+    return {
+        "message": f"{face_count} face(s) detected in the photo.",
+        "detection_mode": job["detection_mode"],
+        "total_faces": face_count,
+        "identified_people": identified_people,
+        "attendance_log": attendance_log
+    }
+
+def run_recognition(data, image_bytes, progress=None):
+    """
+    Synchronous recognition: prepare, detect, search every face concurrently
+    and log attendance. Returns (payload, status) for the response.
+    progress, if given, is a RecognitionJob whose counters are updated as the
+    faces are detected, searched and logged.
+    """
+    job, error = prepare_recognition(data, image_bytes)
+    if error:
+        return error
+
+    try:
+        faces = detect_job_faces(job)
+    except Exception as e:
+        return {"message": f"Failed to detect faces: {str(e)}"}, 500
+    if progress:
+        progress.update(faces_detected=len(faces))
+    if not faces:
+        return recognition_payload(job, faces), 200
+
+    # Search all faces in the collection concurrently (order is preserved)
+    on_searched = (lambda: progress.increment("faces_searched")) if progress else None
+    face_crops = crop_job_faces(job, faces)
+    with metrics.time("attendance_stage_seconds", endpoint="recognize", stage="search"):
+        identified_people = search_faces(face_crops, on_searched)
+    attendance_log = log_attendance(job, identified_people)
+    if progress:
+        progress.update(faces_logged=attendance_log["logged"])
+    return recognition_payload(job, faces, identified_people, attendance_log), 200
+
+# -----------------------------
+# 5h) Background Recognition Jobs
+# -----------------------------
+# POST /recognize?async=1 queues the request and returns a job id at once;
+# a bounded pool of worker threads runs run_recognition and GET /jobs/<id>
+# reports progress and the final result.
+class RecognitionJob:
+    """
+    Status and progress of one queued recognition.
+    """
+    def __init__(self, data, image_bytes):
+        self.id = uuid.uuid4().hex
+        self.data = data
+        self.image_bytes = image_bytes
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.progress = {"faces_detected": None, "faces_searched": 0, "faces_logged": 0}
+        self.result = None
+        self.http_status = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.status = "running"
+
+    def update(self, **counters):
+        with self._lock:
+            self.progress.update(counters)
+
+    def increment(self, counter):
+        with self._lock:
+            self.progress[counter] += 1
+
+    def finish(self, result, http_status):
+        with self._lock:
+            self.status = "done" if http_status < 400 else "failed"
+            self.result = result
+            self.http_status = http_status
+            self.finished_at = time.time()
+            self.data = self.image_bytes = None  # Free the upload
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "progress": dict(self.progress),
+                "result": self.result,
+                "http_status": self.http_status
+            }
+
+recognition_queue = queue.Queue(maxsize=RECOGNITION_QUEUE_SIZE)
+recognition_jobs = {}  # job id -> RecognitionJob
+recognition_jobs_lock = threading.Lock()
+recognition_workers = []
+
+def recognition_worker():
+    while True:
+        job = recognition_queue.get()
+        job.start()
+        try:
+            result, http_status = run_recognition(job.data, job.image_bytes, progress=job)
+        except Exception as e:
+            result, http_status = {"message": f"Recognition failed: {str(e)}"}, 500
+        job.finish(result, http_status)
+        recognition_queue.task_done()
+
+def submit_recognition_job(data, image_bytes):
+    """
+    Queue a recognition for the worker pool (started on first use).
+    Returns the RecognitionJob, or None if the queue is full.
+    """
+    with recognition_jobs_lock:
+        # Forget finished jobs whose results have been kept long enough
+        expired_before = time.time() - JOB_RESULT_TTL
+        for job_id in [j.id for j in recognition_jobs.values() if j.finished_at and j.finished_at < expired_before]:
+            del recognition_jobs[job_id]
+
+        while len(recognition_workers) < RECOGNITION_WORKERS:
+            worker = threading.Thread(target=recognition_worker, name="recognition-worker", daemon=True)
+            worker.start()
+            recognition_workers.append(worker)
+
+        job = RecognitionJob(data, image_bytes)
+        try:
+            recognition_queue.put_nowait(job)
+        except queue.Full:
+            return None
+        recognition_jobs[job.id] = job
+    return job
+
+# -----------------------------
+# 5i) Live Stream Recognition
+# -----------------------------
+# A camera posts frames to one stream. Frames without motion are skipped,
+# faces are tracked across frames, each new track is searched once, and each
+# recognized student is logged once through log_attendance.
+MOTION_FRAME_WIDTH = 160   # Frames are compared at this width
+MOTION_PIXEL_DELTA = 25    # Grey-level change that counts a pixel as moved
+
+def motion_frame(cv_image):
+    """
+    Small blurred greyscale copy of a frame for motion detection.
+    """
+    height, width = cv_image.shape[:2]
+    size = (MOTION_FRAME_WIDTH, max(1, round(height * MOTION_FRAME_WIDTH / width)))
+    gray = cv2.cvtColor(cv2.resize(cv_image, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(gray, (5, 5), 0)
+
+def motion_fraction(previous, current):
+    """
+    Fraction of pixels that changed between two motion frames (1.0 without a previous frame).
+    """
+    if previous is None or previous.shape != current.shape:
+        return 1.0
+    return float(np.count_nonzero(cv2.absdiff(previous, current) > MOTION_PIXEL_DELTA)) / current.size
+
+def box_iou(a, b):
+    """
+    Intersection over union of two Rekognition BoundingBoxes.
+    """
+    inter_w = min(a['Left'] + a['Width'], b['Left'] + b['Width']) - max(a['Left'], b['Left'])
+    inter_h = min(a['Top'] + a['Height'], b['Top'] + b['Height']) - max(a['Top'], b['Top'])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    union = a['Width'] * a['Height'] + b['Width'] * b['Height'] - inter
+    return inter / union if union > 0 else 0.0
+
+def box_center(box):
+    return box['Left'] + box['Width'] / 2, box['Top'] + box['Height'] / 2
+
+class FaceTrack:
+    def __init__(self, track_id, box, now):
+        self.id = track_id
+        self.box = box
+        self.last_seen = now
+        self.status = "searching"  # then "recognized" or "unknown"; stays "searching" while searches fail
+        self.person = None
+        self.logged = False
+
+    def to_dict(self):
+        track = {"track_id": self.id, "box": self.box, "status": self.status, "logged": self.logged}
+        if self.person:
+            track.update(name=self.person.get("name"), student_id=self.person.get("student_id"),
+                         confidence=self.person.get("confidence"))
+        return track
+
+class FaceTracker:
+    """
+    Matches the faces of each frame to the tracks of earlier frames: greedily
+    by IoU, then by centroid distance for faces that moved further than their
+    size. Unmatched faces start new tracks; tracks unseen for `ttl` seconds end.
+    """
+    def __init__(self, iou_threshold=STREAM_TRACK_IOU, ttl=STREAM_TRACK_TTL):
+        self.iou_threshold = iou_threshold
+        self.ttl = ttl
+        self.tracks = {}
+        self._next_id = 1
+
+    def touch(self, now):
+        # A frame without motion still shows the same faces
+        for track in self.tracks.values():
+            track.last_seen = now
+
+    def update(self, boxes, now):
+        """
+        Assign this frame's boxes to tracks. Returns the new tracks.
+        """
+        for track_id in [t.id for t in self.tracks.values() if now - t.last_seen > self.ttl]:
+            del self.tracks[track_id]
+
+        unmatched_tracks = set(self.tracks)
+        unmatched_boxes = set(range(len(boxes)))
+        pairs = sorted(
+            ((box_iou(track.box, boxes[i]), track.id, i) for track in self.tracks.values() for i in unmatched_boxes),
+            reverse=True
+        )
+        for iou, track_id, i in pairs:
+            if iou < self.iou_threshold:
+                break
+            if track_id in unmatched_tracks and i in unmatched_boxes:
+                self._assign(track_id, boxes[i], now, unmatched_tracks, unmatched_boxes, i)
+
+        for i in sorted(unmatched_boxes):
+            cx, cy = box_center(boxes[i])
+            max_distance = max(boxes[i]['Width'], boxes[i]['Height'])
+            nearest = min(
+                unmatched_tracks,
+                key=lambda track_id: math.dist(box_center(self.tracks[track_id].box), (cx, cy)),
+                default=None
+            )
+            if nearest is not None and math.dist(box_center(self.tracks[nearest].box), (cx, cy)) <= max_distance:
+                self._assign(nearest, boxes[i], now, unmatched_tracks, unmatched_boxes, i)
+
+        new_tracks = []
+        for i in sorted(unmatched_boxes):
+            track = FaceTrack(self._next_id, boxes[i], now)
+            self._next_id += 1
+            self.tracks[track.id] = track
+            new_tracks.append(track)
+        return new_tracks
+
+    def _assign(self, track_id, box, now, unmatched_tracks, unmatched_boxes, i):
+        track = self.tracks[track_id]
+        track.box = box
+        track.last_seen = now
+        unmatched_tracks.discard(track_id)
+        unmatched_boxes.discard(i)
+
+class StreamSession:
+    """
+    State of one live camera stream. Frames are processed one at a time;
+    a frame that arrives while the previous one is still running is dropped.
+    """
+    def __init__(self, subject_id="", attendance_session=""):
+        self.id = uuid.uuid4().hex
+        self.job = {"subject_id": subject_id, "attendance_session": attendance_session}
+        self.tracker = FaceTracker()
+        self.previous_frame = None
+        self.last_detect = 0.0
+        self.counts = Counter()
+        self.logged = []  # people logged so far, in order
+        self._lock = threading.Lock()
+
+    def _count(self, outcome):
+        self.counts[outcome] += 1
+        metrics.inc("attendance_stream_frames_total", outcome=outcome)
+
+    def process_frame(self, image_bytes):
+        """
+        Run one frame through motion gating, detection, tracking, search and
+        logging. Returns the stream state; raises ValueError for an undecodable frame.
+        """
+        if not self._lock.acquire(blocking=False):
+            self._count("busy")
+            return {"outcome": "busy"}
+        try:
+            return self._process_frame(image_bytes)
+        finally:
+            self._lock.release()
+
+    def _process_frame(self, image_bytes):
+        now = time.monotonic()
+        with metrics.time("attendance_stage_seconds", endpoint="stream", stage="decode"):
+            cv_image = decode_image(image_bytes)
+        if cv_image is None:
+            raise ValueError("Invalid image data")
+
+        with metrics.time("attendance_stage_seconds", endpoint="stream", stage="motion"):
+            frame = motion_frame(cv_image)
+            motion = motion_fraction(self.previous_frame, frame)
+        # previous_frame is the last frame faces were detected on, so motion in
+        # a frame skipped for the interval still triggers the next detection.
+        # A track whose search failed is retried even in a still scene.
+        retry = any(track.status == "searching" for track in self.tracker.tracks.values())
+        if motion < STREAM_MOTION_THRESHOLD and not retry:
+            self.tracker.touch(now)
+            self._count("no_motion")
+            return self.state("no_motion", motion)
+        if now - self.last_detect < STREAM_DETECT_INTERVAL:
+            self._count("interval")
+            return self.state("interval", motion)
+
+        enhance_image(cv_image)
+        with metrics.time("attendance_stage_seconds", endpoint="stream", stage="detect"):
+            faces = detect_faces_predetected(cv_image, len(image_bytes), endpoint="stream")
+        # Set only once detection succeeds: a failed frame must not become the
+        # motion reference, or the unchanged scene would never be detected again
+        self.last_detect = now
+        self.previous_frame = frame
+        self.tracker.update([face['BoundingBox'] for face in faces], now)
+        self._count("detected")
+
+        # New tracks, and tracks whose last search failed, are searched;
+        # the others keep their identity
+        searching = [
+            track for track in self.tracker.tracks.values()
+            if track.status == "searching" and track.last_seen == now
+        ]
+        if searching:
+            with metrics.time("attendance_stage_seconds", endpoint="stream", stage="search"):
+                results = search_faces([crop_face(cv_image, track.box) for track in searching], endpoint="stream")
+            for track, person in zip(searching, results):
+                if "error" in person:
+                    continue
+                recognized = person.get("student_id") not in (None, "Unknown")
+                track.status = "recognized" if recognized else "unknown"
+                track.person = person if recognized else None
+
+        logged_ids = {person["student_id"] for person in self.logged}
+        to_log = []
+        for track in self.tracker.tracks.values():
+            if track.status != "recognized" or track.logged:
+                continue
+            if track.person["student_id"] in logged_ids:
+                track.logged = True  # Same student seen again under a new track
+            else:
+                to_log.append(track)
+                logged_ids.add(track.person["student_id"])
+
+        newly_logged = []
+        if to_log:
+            attendance_log = log_attendance(self.job, [track.person for track in to_log])
+            failed_ids = {failure["student_id"] for failure in attendance_log["failed"]}
+            for track in to_log:
+                if track.person["student_id"] not in failed_ids:
+                    track.logged = True
+                    self.logged.append(track.person)
+                    newly_logged.append(track.person)
+        return self.state("detected", motion, newly_logged)
+
+    def state(self, outcome, motion=None, newly_logged=()):
+        return {
+            "stream_id": self.id,
+            "outcome": outcome,
+            "motion": round(motion, 4) if motion is not None else None,
+            "tracks": [track.to_dict() for track in self.tracker.tracks.values()],
+            "newly_logged": list(newly_logged),
+            "logged": list(self.logged),
+            "frames": dict(self.counts)
+        }
+
+stream_sessions = TTLCache(STREAM_MAX_SESSIONS, STREAM_IDLE_TIMEOUT)
+
+def start_stream_session(data):
+    """
+    Start a stream, or return None when STREAM_MAX_SESSIONS streams are
+    active (an active camera is never evicted to make room).
+    """
+    session = StreamSession(
+        subject_id=data.get("subject_id") or "",
+        attendance_session=str(data.get("attendance_session") or "").strip()
+    )
+    if not stream_sessions.add(session.id, session):
+        return None
+    return session
 
-    return enhanced_pil_image
+def get_stream_session(stream_id):
+    """
+    Return the live session (refreshing its idle timeout), or None.
+    """
+    session = stream_sessions.get(stream_id)
+    if session is not None:
+        stream_sessions.put(stream_id, session)
+    return session
 
 # -----------------------------
 # 6) Single-Page HTML + Chat Widget
@@ -234,6 +2042,11 @@ INDEX_HTML = """
       Recognize
     </button>
   </li>
+  <li class="nav-item">
+    <button class="nav-link" id="live-tab" data-bs-toggle="tab" data-bs-target="#live" type="button" role="tab">
+      Live Camera
+    </button>
+  </li>
   <li class="nav-item">
     <button class="nav-link" id="subjects-tab" data-bs-toggle="tab" data-bs-target="#subjects" type="button" role="tab">
       Subjects
@@ -267,12 +2080,30 @@ INDEX_HTML = """
     <select id="rec_subject_select" class="form-control mb-2">
       <option value="">-- No Subject --</option>
     </select>
+    <label class="form-label">Detection Mode</label>
+    <select id="rec_detection_mode" class="form-control mb-2">
+      <option value="full">Full frame</option>
+      <option value="tiled">Tiled (large group photos)</option>
+    </select>
     <label class="form-label">Image</label>
     <input type="file" id="rec_image" class="form-control" accept="image/*" />
     <button onclick="recognizeFace()" class="btn btn-success mt-2">Recognize</button>
     <div id="recognize_result" class="alert alert-info mt-3" style="display:none;"></div>
   </div>
 
+  <!-- LIVE CAMERA -->
+  <div class="tab-pane fade mt-4" id="live" role="tabpanel" aria-labelledby="live-tab">
+    <h3>Live Camera</h3>
+    <label class="form-label">Subject (optional)</label>
+    <select id="live_subject_select" class="form-control mb-2">
+      <option value="">-- No Subject --</option>
+    </select>
+    <video id="live_video" autoplay muted playsinline class="d-block mb-2" style="max-width:100%; width:480px; background:#000;"></video>
+    <button id="live_start" onclick="startLive()" class="btn btn-success">Start</button>
+    <button id="live_stop" onclick="stopLive()" class="btn btn-secondary" disabled>Stop</button>
+    <div id="live_result" class="alert alert-info mt-3" style="display:none; white-space:pre-line;"></div>
+  </div>
+
   <!-- SUBJECTS -->
   <div class="tab-pane fade mt-4" id="subjects" role="tabpanel" aria-labelledby="subjects-tab">
     <h3>Manage Subjects</h3>
@@ -376,24 +2207,40 @@ INDEX_HTML = """
     chatWindow.style.display = 'none';
   });
 
+  // Chat memory is kept per session on the server; the id survives page reloads in this tab
+  let chatSessionId = sessionStorage.getItem('chatSessionId');
+
   function sendMessage() {
     const userMessage = chatInput.value.trim();
     if (!userMessage) return;
     addMessage(userMessage, 'user');
     chatInput.value = '';
 
-    fetch('/process_prompt', {
+    fetch('/process_prompt?stream=1', {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ prompt: userMessage })
+      headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+      body: JSON.stringify({ prompt: userMessage, session_id: chatSessionId })
     })
-    .then(res => res.json())
-    .then(data => {
-      if (data.error) {
-        addMessage("Error: " + data.error, 'assistant');
-      } else {
-        addMessage(data.message, 'assistant');
+    .then(res => {
+      if (!res.ok || !res.body) {
+        return res.json().then(data => addMessage("Error: " + (data.error || data.message), 'assistant'));
       }
+      // Read the server-sent events as they arrive and grow one reply bubble
+      const replyDiv = addMessage('', 'assistant');
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      const read = () => reader.read().then(({ done, value }) => {
+        if (done) return;
+        buffer += decoder.decode(value, { stream: true });
+        let end;
+        while ((end = buffer.indexOf('\\n\\n')) !== -1) {
+          handleChatEvent(buffer.slice(0, end), replyDiv);
+          buffer = buffer.slice(end + 2);
+        }
+        return read();
+      });
+      return read();
     })
     .catch(err => {
       addMessage("Network or server error!", 'assistant');
@@ -401,12 +2248,33 @@ INDEX_HTML = """
     });
   }
 
+  function handleChatEvent(block, replyDiv) {
+    let event = 'message';
+    let data = '';
+    block.split('\\n').forEach(line => {
+      if (line.startsWith('event: ')) event = line.slice(7);
+      else if (line.startsWith('data: ')) data += line.slice(6);
+    });
+    if (!data) return;
+    const payload = JSON.parse(data);
+    if (event === 'session') {
+      chatSessionId = payload.session_id;
+      sessionStorage.setItem('chatSessionId', chatSessionId);
+    } else if (event === 'done') {
+      replyDiv.textContent = payload.message;
+    } else {
+      replyDiv.textContent += payload.text;
+    }
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+  }
+
   function addMessage(text, sender) {
     const div = document.createElement('div');
     div.classList.add('message', sender);
     div.textContent = text;
     chatMessages.appendChild(div);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return div;
   }
 
   chatSendBtn.addEventListener('click', sendMessage);
@@ -419,14 +2287,6 @@ INDEX_HTML = """
 
   /* -------------- Register + Recognize + Subjects + Attendance -------------- */
   let table;
-  let attendanceData = [];
-
-  function getBase64(file, callback) {
-    const reader = new FileReader();
-    reader.readAsDataURL(file);
-    reader.onload = () => callback(reader.result);
-    reader.onerror = (error) => console.error('Error:', error);
-  }
 
   /* Register Face */
   function registerFace() {
@@ -437,23 +2297,27 @@ INDEX_HTML = """
       alert('Please provide name, student ID, and an image.');
       return;
     }
-    getBase64(file, (base64Str) => {
-      fetch('/register', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ name, student_id: studentId, image: base64Str })
-      })
-      .then(res => res.json())
-      .then(data => {
-        const div = document.getElementById('register_result');
-        div.style.display = 'block';
-        div.textContent = data.message || data.error || JSON.stringify(data);
-      })
-      .catch(err => console.error(err));
-    });
+    // Send the file as binary multipart instead of a base64 data URL
+    const formData = new FormData();
+    formData.append('name', name);
+    formData.append('student_id', studentId);
+    formData.append('image', file);
+    fetch('/register', {
+      method: 'POST',
+      body: formData
+    })
+    .then(res => res.json())
+    .then(data => {
+      const div = document.getElementById('register_result');
+      div.style.display = 'block';
+      div.textContent = data.message || data.error || JSON.stringify(data);
+    })
+    .catch(err => console.error(err));
   }
 
-  /* Recognize Faces */
+  /* Recognize Faces (with RECOGNIZE_UI_ASYNC=1: queued as a background job, polled until done) */
+  const RECOGNIZE_ASYNC = {{ recognize_async|tojson }};
+
   function recognizeFace() {
     const file = document.getElementById('rec_image').files[0];
     const subjectId = document.getElementById('rec_subject_select').value;
@@ -461,27 +2325,76 @@ INDEX_HTML = """
       alert('Please select an image to recognize.');
       return;
     }
-    getBase64(file, (base64Str) => {
-      fetch('/recognize', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ image: base64Str, subject_id: subjectId })
-      })
-      .then(res => res.json())
-      .then(data => {
-        const div = document.getElementById('recognize_result');
-        div.style.display = 'block';
-        let text = data.message || data.error || JSON.stringify(data);
-        if (data.identified_people) {
-          text += "\\n\\nIdentified People:\\n";
-          data.identified_people.forEach((p) => {
-            text += `- ${p.name || "Unknown"} (ID: ${p.student_id || "N/A"}), Confidence: ${p.confidence}\\n`;
-          });
-        }
-        div.textContent = text;
-      })
-      .catch(err => console.error(err));
-    });
+    const formData = new FormData();
+    formData.append('subject_id', subjectId);
+    formData.append('detection_mode', document.getElementById('rec_detection_mode').value);
+    formData.append('image', file);
+    const div = document.getElementById('recognize_result');
+    div.style.display = 'block';
+    div.textContent = 'Uploading...';
+    submitRecognition(formData, RECOGNIZE_ASYNC);
+  }
+
+  function submitRecognition(formData, queued) {
+    fetch(queued ? '/recognize?async=1' : '/recognize', {
+      method: 'POST',
+      body: formData
+    })
+    .then(res => res.json())
+    .then(data => {
+      if (data.job_id) {
+        pollRecognitionJob(data.job_id, formData);
+      } else {
+        showRecognitionResult(data);
+      }
+    })
+    .catch(err => console.error(err));
+  }
+
+  function pollRecognitionJob(jobId, formData) {
+    fetch('/jobs/' + jobId)
+    .then(res => {
+      if (res.status === 404) {
+        // The poll reached a worker process that does not hold the job
+        document.getElementById('recognize_result').textContent = 'Job not found on this server; recognizing directly...';
+        submitRecognition(formData, false);
+        return null;
+      }
+      return res.json();
+    })
+    .then(job => {
+      if (!job) return;
+      if (job.status === 'done' || job.status === 'failed' || job.error) {
+        showRecognitionResult(job.result || job);
+        return;
+      }
+      const p = job.progress;
+      const div = document.getElementById('recognize_result');
+      div.textContent = (p.faces_detected === null)
+        ? `Detecting faces (${job.status})...`
+        : `${p.faces_detected} face(s) detected, ${p.faces_searched} searched, ${p.faces_logged} logged...`;
+      setTimeout(() => pollRecognitionJob(jobId, formData), 1000);
+    })
+    .catch(err => console.error(err));
+  }
+
+  function showRecognitionResult(data) {
+    const div = document.getElementById('recognize_result');
+    div.style.display = 'block';
+    let text = data.message || data.error || JSON.stringify(data);
+    if (data.identified_people) {
+      text += "\\n\\nIdentified People:\\n";
+      data.identified_people.forEach((p) => {
+        text += `- ${p.name || "Unknown"} (ID: ${p.student_id || "N/A"}), Confidence: ${p.confidence}\\n`;
+      });
+    }
+    if (data.attendance_log && data.attendance_log.failed.length) {
+      text += `\\nFailed to log attendance for ${data.attendance_log.failed.length} student(s):\\n`;
+      data.attendance_log.failed.forEach((f) => {
+        text += `- ${f.name} (ID: ${f.student_id}): ${f.error}\\n`;
+      });
+    }
+    div.textContent = text;
   }
 
   /* Subjects */
@@ -511,13 +2424,15 @@ INDEX_HTML = """
     fetch('/get_subjects')
     .then(res => res.json())
     .then(data => {
-      const select = document.getElementById('rec_subject_select');
-      select.innerHTML = '<option value="">-- No Subject --</option>';
-      (data.subjects || []).forEach(sub => {
-        const option = document.createElement('option');
-        option.value = sub.id;
-        option.textContent = sub.name;
-        select.appendChild(option);
+      ['rec_subject_select', 'live_subject_select'].forEach(selectId => {
+        const select = document.getElementById(selectId);
+        select.innerHTML = '<option value="">-- No Subject --</option>';
+        (data.subjects || []).forEach(sub => {
+          const option = document.createElement('option');
+          option.value = sub.id;
+          option.textContent = sub.name;
+          select.appendChild(option);
+        });
       });
       const list = document.getElementById('subjects_list');
       list.innerHTML = '';
@@ -530,60 +2445,92 @@ INDEX_HTML = """
     .catch(err => console.error(err));
   }
 
-  /* Attendance */
-  function loadAttendance() {
-    const studentId = document.getElementById('filter_student_id').value.trim();
-    const subjectId = document.getElementById('filter_subject_id').value.trim();
-    const startDate = document.getElementById('filter_start').value;
-    const endDate = document.getElementById('filter_end').value;
+  /* Attendance (server-side DataTable backed by cursor pagination) */
+  const ATTENDANCE_COLUMNS = ['doc_id', 'student_id', 'name', 'subject_id', 'subject_name', 'timestamp', 'status'];
+  let attendanceCursors = {0: null};  // row offset -> start_after token
+  let attendanceQueryKey = '';
 
-    let url = '/api/attendance?';
-    if (studentId) url += 'student_id=' + studentId + '&';
-    if (subjectId) url += 'subject_id=' + subjectId + '&';
-    if (startDate) url += 'start_date=' + startDate + '&';
-    if (endDate) url += 'end_date=' + endDate + '&';
-
-    fetch(url)
-      .then(res => res.json())
-      .then(data => {
-        attendanceData = data;
-        renderAttendanceTable(attendanceData);
-      })
-      .catch(err => console.error(err));
+  function attendanceFilterParams() {
+    const params = new URLSearchParams();
+    const studentId = document.getElementById('filter_student_id').value.trim();
+    const subjectId = document.getElementById('filter_subject_id').value.trim();
+    const startDate = document.getElementById('filter_start').value;
+    const endDate = document.getElementById('filter_end').value;
+    if (studentId) params.set('student_id', studentId);
+    if (subjectId) params.set('subject_id', subjectId);
+    if (startDate) params.set('start_date', startDate);
+    if (endDate) params.set('end_date', endDate);
+    return params;
   }
 
-  function renderAttendanceTable(data) {
+  function loadAttendance() {
+    attendanceCursors = {0: null};
+    attendanceQueryKey = '';
     if ($.fn.DataTable.isDataTable('#attendanceTable')) {
-      $('#attendanceTable').DataTable().clear().destroy();
+      table.ajax.reload();
+      return;
     }
-    const tbody = document.querySelector('#attendanceTable tbody');
-    tbody.innerHTML = '';
-    data.forEach(record => {
-      const row = document.createElement('tr');
-      row.innerHTML = `
-        <td>${record.doc_id || ''}</td>
-        <td contenteditable="true">${record.student_id || ''}</td>
-        <td contenteditable="true">${record.name || ''}</td>
-        <td contenteditable="true">${record.subject_id || ''}</td>
-        <td contenteditable="true">${record.subject_name || ''}</td>
-        <td contenteditable="true">${record.timestamp || ''}</td>
-        <td contenteditable="true">${record.status || ''}</td>
-      `;
-      tbody.appendChild(row);
-    });
-    $('#attendanceTable').DataTable({
+    table = $('#attendanceTable').DataTable({
+      serverSide: true,
+      processing: true,
       paging: true,
+      pagingType: 'simple',
       searching: false,
       info: false,
-      responsive: true
+      responsive: true,
+      order: [[5, 'desc']],
+      columns: ATTENDANCE_COLUMNS.map((name, i) => ({
+        data: name,
+        defaultContent: '',
+        orderable: i > 0,
+        createdCell: i > 0 ? (td) => td.setAttribute('contenteditable', 'true') : undefined
+      })),
+      ajax: fetchAttendancePage
     });
   }
 
+  function fetchAttendancePage(req, callback) {
+    const params = attendanceFilterParams();
+    const order = (req.order && req.order.length) ? req.order[0] : { column: 5, dir: 'desc' };
+    params.set('order_by', ATTENDANCE_COLUMNS[order.column]);
+    params.set('order', order.dir);
+    params.set('limit', req.length);
+
+    // Cursors are only valid for the same filters, sort and page size
+    const key = params.toString();
+    if (key !== attendanceQueryKey) {
+      attendanceCursors = {0: null};
+      attendanceQueryKey = key;
+    }
+    const start = (req.start in attendanceCursors) ? req.start : 0;
+    if (attendanceCursors[start]) params.set('start_after', attendanceCursors[start]);
+
+    const empty = { draw: req.draw, recordsTotal: 0, recordsFiltered: 0, data: [] };
+    fetch('/api/attendance?' + params.toString())
+      .then(res => res.json())
+      .then(data => {
+        if (data.error) {
+          alert(data.error);
+          callback(empty);
+          return;
+        }
+        if (data.next_cursor) attendanceCursors[start + req.length] = data.next_cursor;
+        // Total is unknown with cursors; report one extra row while more pages exist
+        const seen = start + data.records.length + (data.has_more ? 1 : 0);
+        callback({ draw: req.draw, recordsTotal: seen, recordsFiltered: seen, data: data.records });
+      })
+      .catch(err => {
+        console.error(err);
+        callback(empty);
+      });
+  }
+
   function saveEdits() {
     const rows = document.querySelectorAll('#attendanceTable tbody tr');
     const updatedRecords = [];
     rows.forEach(row => {
       const cells = row.querySelectorAll('td');
+      if (cells.length < ATTENDANCE_COLUMNS.length) return;  // "No data" placeholder row
       const doc_id = cells[0].textContent.trim();
       const student_id = cells[1].textContent.trim();
       const name = cells[2].textContent.trim();
@@ -640,12 +2587,97 @@ INDEX_HTML = """
     })
     .then(res => res.json())
     .then(resp => {
-      alert(resp.message || resp.error || 'Excel uploaded');
+      let text = resp.message || resp.error || 'Excel uploaded';
+      if (resp.errors && resp.errors.length) {
+        text += '\\n' + resp.errors.slice(0, 20).map(e => `Row ${e.row}: ${e.error}`).join('\\n');
+        if (resp.errors.length > 20) text += `\\n...and ${resp.errors.length - 20} more`;
+      }
+      alert(text);
       loadAttendance();
     })
     .catch(err => console.error(err));
   }
 
+  /* -------------- Live Camera -------------- */
+  const LIVE_FRAME_INTERVAL_MS = 500;
+  let liveStreamId = null;
+  let liveTimer = null;
+  let liveCamera = null;
+
+  function startLive() {
+    navigator.mediaDevices.getUserMedia({ video: true, audio: false })
+    .then(camera => {
+      liveCamera = camera;
+      document.getElementById('live_video').srcObject = camera;
+      return fetch('/stream/start', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ subject_id: document.getElementById('live_subject_select').value })
+      });
+    })
+    .then(res => res.json())
+    .then(data => {
+      if (data.error) throw data.error;
+      liveStreamId = data.stream_id;
+      document.getElementById('live_start').disabled = true;
+      document.getElementById('live_stop').disabled = false;
+      liveTimer = setInterval(sendLiveFrame, LIVE_FRAME_INTERVAL_MS);
+    })
+    .catch(err => {
+      alert('Could not start the camera: ' + err);
+      stopLive();
+    });
+  }
+
+  function sendLiveFrame() {
+    const video = document.getElementById('live_video');
+    if (!liveStreamId || !video.videoWidth) return;
+    const canvas = document.createElement('canvas');
+    canvas.width = video.videoWidth;
+    canvas.height = video.videoHeight;
+    canvas.getContext('2d').drawImage(video, 0, 0);
+    canvas.toBlob(blob => {
+      if (!blob || !liveStreamId) return;
+      fetch(`/stream/${liveStreamId}/frame`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'image/jpeg' },
+        body: blob
+      })
+      .then(res => {
+        if (res.status === 404) {
+          // The stream expired or was stopped on the server
+          stopLive();
+          alert('The live stream has ended. Press Start to begin a new one.');
+          return null;
+        }
+        return res.json();
+      })
+      .then(data => data && showLiveState(data))
+      .catch(err => console.error(err));
+    }, 'image/jpeg', 0.8);
+  }
+
+  function showLiveState(data) {
+    if (data.error || !data.tracks) return;
+    const div = document.getElementById('live_result');
+    const people = data.logged.map(p => `- ${p.name} (ID: ${p.student_id})`).join('\\n');
+    div.style.display = 'block';
+    div.textContent = `Faces in view: ${data.tracks.length}\\nLogged ${data.logged.length} student(s):\\n${people}`;
+  }
+
+  function stopLive() {
+    if (liveTimer) clearInterval(liveTimer);
+    liveTimer = null;
+    if (liveCamera) liveCamera.getTracks().forEach(track => track.stop());
+    liveCamera = null;
+    if (liveStreamId) {
+      fetch(`/stream/${liveStreamId}`, { method: 'DELETE' }).catch(err => console.error(err));
+    }
+    liveStreamId = null;
+    document.getElementById('live_start').disabled = false;
+    document.getElementById('live_stop').disabled = true;
+  }
+
   document.addEventListener('DOMContentLoaded', () => {
     loadSubjects();
   });
@@ -658,11 +2690,47 @@ INDEX_HTML = """
 # 7) Routes
 # -----------------------------
 
+def read_uploaded_image():
+    """
+    Read the form fields and image bytes of an upload request. Accepts:
+      - multipart/form-data with the image in the 'image' file field,
+      - a raw image/* or application/octet-stream body (fields in the query string),
+      - JSON with a base64 data URL in 'image' (the original format).
+    Returns (fields, image_bytes); image_bytes is None if no image was sent.
+    Raises ValueError for malformed base64 or a JSON body that is not an object.
+    """
+    endpoint = request.url_rule.rule.strip("/") if request.url_rule else "unmatched"
+    with metrics.time("attendance_stage_seconds", endpoint=endpoint, stage="read_upload"):
+        return _read_uploaded_image()
+
+def _read_uploaded_image():
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("image")
+        return request.form, (upload.read() or None) if upload else None
+    if request.mimetype.startswith("image/") or request.mimetype == "application/octet-stream":
+        return request.args, request.get_data(cache=False) or None
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        raise ValueError("JSON body must be an object")
+    image_str = data.get("image")
+    if not image_str:
+        return data, None
+    if not isinstance(image_str, str):
+        raise ValueError("'image' must be a base64 string")
+    # Accept both "data:image/...;base64,<data>" and bare base64
+    return data, base64.b64decode(image_str.partition(",")[2] or image_str, validate=True)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = (request.max_content_length or 0) / (1024 * 1024)
+    return jsonify({"message": f"Upload too large. The maximum request size is {limit_mb:g} MB."}), 413
+
 # Root route to avoid "URL not found" on /
 @app.route("/", methods=["GET"])
 def index():
     # Return the single-page UI
-    return render_template_string(INDEX_HTML)
+    return render_template_string(INDEX_HTML, recognize_async=RECOGNIZE_UI_ASYNC)
 
 # Register Face (GET/POST)
 @app.route("/register", methods=["GET","POST"])
@@ -670,40 +2738,90 @@ def register_face():
     if request.method == "GET":
         return "Welcome to /register. Please POST with {name, student_id, image} to register."
 
-    data = request.json
-    name = data.get('name')
-    student_id = data.get('student_id')
-    image = data.get('image')
-    if not name or not student_id or not image:
-        return jsonify({"message": "Missing name, student_id, or image"}), 400
-
-    sanitized_name = "".join(c if c.isalnum() or c in "_-." else "_" for c in name)
-    image_data = image.split(",")[1]
-    image_bytes = base64.b64decode(image_data)
+    try:
+        data, image_bytes = read_uploaded_image()
+    except ValueError:
+        return jsonify({"message": "Invalid image data"}), 400
+    payload, status = run_registration(data, image_bytes)
+    return jsonify(payload), status
+
+# Bulk enrollment: a ZIP archive, or a CSV manifest plus the image files
+@app.route("/register/bulk", methods=["POST"])
+def register_bulk():
+    """
+    Either 'archive': a ZIP of images with a manifest.csv (name, student_id, image)
+    or named "<name>_<student_id>.<ext>"; or 'manifest': a CSV (name, student_id,
+    image) plus the images as repeated 'images' file fields.
+    Pass resume=0 to re-index students already in the collection.
+    """
+    resume = (request.form.get("resume") or request.args.get("resume") or "1") not in ("0", "false")
+    archive = request.files.get("archive")
+    manifest = request.files.get("manifest")
 
-    # Enhance image before indexing
-    pil_image = Image.open(io.BytesIO(image_bytes))
-    enhanced_image = enhance_image(pil_image)
-    buffered = io.BytesIO()
-    enhanced_image.save(buffered, format="JPEG")
-    enhanced_image_bytes = buffered.getvalue()
+    if archive:
+        try:
+            zf = zipfile.ZipFile(archive.stream)
+        except zipfile.BadZipFile:
+            return jsonify({"error": "archive is not a valid ZIP file"}), 400
+        with zf:
+            members = {
+                os.path.basename(info.filename): info
+                for info in zf.infolist()
+                if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+            }
 
-    external_image_id = f"{sanitized_name}_{student_id}"
-    try:
-        response = rekognition_client.index_faces(
-            CollectionId=COLLECTION_ID,
-            Image={'Bytes': enhanced_image_bytes},
-            ExternalImageId=external_image_id,
-            DetectionAttributes=['ALL'],
-            QualityFilter='AUTO'
+            def read_member(filename):
+                info = members.get(os.path.basename(filename or ""))
+                if info is None:
+                    raise ValueError(f"Image '{filename}' not found in archive")
+                if info.file_size > app.config["MAX_CONTENT_LENGTH"]:
+                    raise ValueError(f"Image '{filename}' is larger than {MAX_UPLOAD_MB:g} MB")
+                return zf.read(info)
+
+            if "manifest.csv" in members:
+                rows = csv.DictReader(io.TextIOWrapper(io.BytesIO(zf.read(members.pop("manifest.csv"))), encoding="utf-8-sig"))
+                entries = (
+                    ((row.get("name") or "").strip(), (row.get("student_id") or "").strip(),
+                     functools.partial(read_member, row.get("image")))
+                    for row in rows
+                )
+            else:
+                entries = []
+                for filename in sorted(members):
+                    stem = os.path.splitext(filename)[0]
+                    name, _, student_id = stem.rpartition("_")
+                    entries.append((name, student_id, functools.partial(read_member, filename)))
+
+            results = run_bulk_registration(entries, resume)
+    elif manifest:
+        images = {os.path.basename(f.filename): f for f in request.files.getlist("images")}
+
+        def read_upload(filename):
+            upload = images.get(os.path.basename(filename or ""))
+            if upload is None:
+                raise ValueError(f"Image '{filename}' was not uploaded")
+            return upload.read()
+
+        rows = csv.DictReader(io.TextIOWrapper(manifest.stream, encoding="utf-8-sig"))
+        entries = (
+            ((row.get("name") or "").strip(), (row.get("student_id") or "").strip(),
+             functools.partial(read_upload, row.get("image")))
+            for row in rows
         )
-    except Exception as e:
-        return jsonify({"message": f"Failed to index face: {str(e)}"}), 500
-
-    if not response.get('FaceRecords'):
-        return jsonify({"message": "No face detected in the image"}), 400
+        results = run_bulk_registration(entries, resume)
+    else:
+        return jsonify({"error": "Upload a ZIP 'archive' or a CSV 'manifest' with 'images'"}), 400
 
-    return jsonify({"message": f"Student {name} with ID {student_id} registered successfully!"}), 200
+    counts = Counter(r["status"] for r in results)
+    if counts["registered"]:
+        face_search_cache.clear()
+    return jsonify({
+        "message": f"{counts['registered']} registered, {counts['skipped']} skipped, {counts['failed']} failed.",
+        "registered": counts["registered"],
+        "skipped": counts["skipped"],
+        "failed": counts["failed"],
+        "results": results
+    }), 200
 
 # Recognize Face (GET/POST)
 @app.route("/recognize", methods=["GET","POST"])
@@ -711,125 +2829,98 @@ def recognize_face():
     if request.method == "GET":
         return "Welcome to /recognize. Please POST with {image, subject_id(optional)} to detect faces."
 
-    data = request.json
-    image_str = data.get('image')
-    subject_id = data.get('subject_id') or ""
-    if not image_str:
-        return jsonify({"message": "No image provided"}), 400
-
-    # Optionally fetch subject name
-    subject_name = ""
-    if subject_id:
-        sdoc = db.collection("subjects").document(subject_id).get()
-        if sdoc.exists:
-            subject_name = sdoc.to_dict().get("name", "")
-        else:
-            subject_name = "Unknown Subject"
-
-    image_data = image_str.split(",")[1]
-    image_bytes = base64.b64decode(image_data)
-
-    # Enhance image before detection
-    pil_image = Image.open(io.BytesIO(image_bytes))
-    enhanced_image = enhance_image(pil_image)
-    buffered = io.BytesIO()
-    enhanced_image.save(buffered, format="JPEG")
-    enhanced_image_bytes = buffered.getvalue()
-
     try:
-        # Detect faces in the image
-        detect_response = rekognition_client.detect_faces(
-            Image={'Bytes': enhanced_image_bytes},
-            Attributes=['ALL']
-        )
+        data, image_bytes = read_uploaded_image()
+    except ValueError:
+        return jsonify({"message": "Invalid image data"}), 400
+
+    if request.args.get("async") in ("1", "true"):
+        if not image_bytes:
+            return jsonify({"message": "No image provided"}), 400
+        job = submit_recognition_job(dict(data), image_bytes)
+        if job is None:
+            return jsonify({"message": "Recognition queue is full, please try again shortly."}), 503
+        return jsonify({"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"}), 202
+
+    payload, status = run_recognition(data, image_bytes)
+    return jsonify(payload), status
+
+# Background recognition job status
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = recognition_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job id"}), 404
+    return jsonify(job.to_dict()), 200
+
+# Live camera streams
+@app.route("/stream/start", methods=["POST"])
+def start_stream():
+    data = request.get_json(silent=True) or request.form
+    session = start_stream_session(data)
+    if session is None:
+        return jsonify({"error": "Too many live streams are running. Try again later."}), 503
+    return jsonify({"stream_id": session.id, "frame_url": f"/stream/{session.id}/frame"}), 201
+
+@app.route("/stream/<stream_id>/frame", methods=["POST"])
+def stream_frame(stream_id):
+    session = get_stream_session(stream_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired stream id"}), 404
+    try:
+        _, image_bytes = read_uploaded_image()
+        if not image_bytes:
+            return jsonify({"error": "No frame provided"}), 400
+        return jsonify(session.process_frame(image_bytes)), 200
+    except ValueError:
+        return jsonify({"error": "Invalid image data"}), 400
     except Exception as e:
-        return jsonify({"message": f"Failed to detect faces: {str(e)}"}), 500
-
-    faces = detect_response.get('FaceDetails', [])
-    face_count = len(faces)
-    identified_people = []
-
-    if face_count == 0:
-        return jsonify({
-            "message": "No faces detected in the image.",
-            "total_faces": face_count,
-            "identified_people": identified_people
-        }), 200
-
-    for idx, face in enumerate(faces):
-        # Rekognition provides bounding box coordinates relative to image dimensions
-        bbox = face['BoundingBox']
-        pil_img = Image.open(io.BytesIO(enhanced_image_bytes))
-        img_width, img_height = pil_img.size
-
-        left = int(bbox['Left'] * img_width)
-        top = int(bbox['Top'] * img_height)
-        width = int(bbox['Width'] * img_width)
-        height = int(bbox['Height'] * img_height)
-        right = left + width
-        bottom = top + height
-
-        # Crop the face from the image
-        cropped_face = pil_img.crop((left, top, right, bottom))
-        buffer = io.BytesIO()
-        cropped_face.save(buffer, format="JPEG")
-        cropped_face_bytes = buffer.getvalue()
-
-        try:
-            # Search for the face in the collection
-            search_response = rekognition_client.search_faces_by_image(
-                CollectionId=COLLECTION_ID,
-                Image={'Bytes': cropped_face_bytes},
-                MaxFaces=1,
-                FaceMatchThreshold=60
-            )
-        except Exception as e:
-            identified_people.append({
-                "message": f"Error searching face {idx+1}: {str(e)}",
-                "confidence": "N/A"
-            })
-            continue
-
-        matches = search_response.get('FaceMatches', [])
-        if not matches:
-            identified_people.append({
-                "message": "Face not recognized",
-                "confidence": "N/A"
-            })
-            continue
-
-        match = matches[0]
-        ext_id = match['Face']['ExternalImageId']
-        confidence = match['Face']['Confidence']
-
-        parts = ext_id.split("_", 1)
-        if len(parts) == 2:
-            rec_name, rec_id = parts
-        else:
-            rec_name, rec_id = ext_id, "Unknown"
-
-        identified_people.append({
-            "name": rec_name,
-            "student_id": rec_id,
-            "confidence": confidence
-        })
-
-        # If recognized, log attendance
-        if rec_id != "Unknown":
-            doc = {
-                "student_id": rec_id,
-                "name": rec_name,
-                "timestamp": datetime.utcnow().isoformat(),
-                "subject_id": subject_id,
-                "subject_name": subject_name,
-                "status": "PRESENT"
-            }
-            db.collection("attendance").add(doc)
+        return jsonify({"error": f"Failed to process frame: {str(e)}"}), 500
+
+@app.route("/stream/<stream_id>", methods=["GET", "DELETE"])
+def stream_status(stream_id):
+    session = get_stream_session(stream_id)
+    if session is None:
+        return jsonify({"error": "Unknown or expired stream id"}), 404
+    if request.method == "DELETE":
+        stream_sessions.discard(stream_id)
+    return jsonify(session.state("stopped" if request.method == "DELETE" else "status")), 200
+
+# Cache statistics
+@app.route("/api/cache_stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "face_search": face_search_cache.stats(),
+        "subjects": subjects_cache.stats(),
+        "chat_responses": chat_response_cache.stats()
+    }), 200
 
+@app.route("/api/rekognition_stats", methods=["GET"])
+def rekognition_stats():
+    return jsonify(rekognition_client.stats()), 200
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        endpoint = request.endpoint or "unmatched"
+        metrics.observe("attendance_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc("attendance_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/startup", methods=["GET"])
+def startup_stats():
     return jsonify({
-        "message": f"{face_count} face(s) detected in the photo.",
-        "total_faces": face_count,
-        "identified_people": identified_people
+        "timings": startup_timings,
+        "initialized": {client.name: client.initialized for client in LAZY_CLIENTS}
     }), 200
 
 # SUBJECTS
@@ -840,31 +2931,49 @@ def add_subject():
     if not subject_name:
         return jsonify({"error": "No subject_name provided"}), 400
     doc_ref = db.collection("subjects").document()
-    doc_ref.set({
-        "name": subject_name.strip(),
-        "created_at": datetime.utcnow().isoformat()
-    })
+    with cloud_call("firestore", "set"):
+        doc_ref.set({
+            "name": subject_name.strip(),
+            "created_at": datetime.utcnow().isoformat()
+        })
+    subjects_cache.clear()
     return jsonify({"message": f"Subject '{subject_name}' added successfully!"}), 200
 
 @app.route("/get_subjects", methods=["GET"])
 def get_subjects():
-    subs = db.collection("subjects").stream()
-    subj_list = []
-    for s in subs:
-        d = s.to_dict()
-        subj_list.append({"id": s.id, "name": d.get("name","")})
+    subj_list = [{"id": sid, "name": name} for sid, name in get_all_subjects().items()]
     return jsonify({"subjects": subj_list}), 200
 
 # ATTENDANCE
 import openpyxl
 from openpyxl import Workbook
 
-@app.route("/api/attendance", methods=["GET"])
-def get_attendance():
-    student_id = request.args.get("student_id")
-    subject_id = request.args.get("subject_id")
-    start_date = request.args.get("start_date")
-    end_date = request.args.get("end_date")
+ATTENDANCE_HEADERS = ["doc_id", "student_id", "name", "subject_id", "subject_name", "timestamp", "status"]
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXPORT_CHUNK_SIZE = 64 * 1024  # Bytes per chunk when streaming exported files
+ATTENDANCE_SORT_FIELDS = ATTENDANCE_HEADERS[1:]
+ATTENDANCE_MAX_PAGE_SIZE = 500
+
+def missing_index_response(error):
+    """
+    JSON error for a query that Firestore refuses without a composite index.
+    Firestore's message includes a console link that creates the index.
+    """
+    return jsonify({
+        "error": "This filter and sort combination needs a Firestore composite index "
+                 "(see 'Firestore Indexes' in the README). " + str(error)
+    }), 500
+
+def build_attendance_query(args):
+    """
+    Build the filtered attendance query from request args
+    (student_id, subject_id, start_date, end_date).
+    Returns (query, error_response); error_response is None when the args are valid.
+    """
+    student_id = args.get("student_id")
+    subject_id = args.get("subject_id")
+    start_date = args.get("start_date")
+    end_date = args.get("end_date")
 
     query = db.collection("attendance")
     if student_id:
@@ -876,7 +2985,7 @@ def get_attendance():
             dt_start = datetime.strptime(start_date, "%Y-%m-%d")
             query = query.where("timestamp", ">=", dt_start.isoformat())
         except ValueError:
-            return jsonify({"error": "Invalid start_date format. Use YYYY-MM-DD."}), 400
+            return None, (jsonify({"error": "Invalid start_date format. Use YYYY-MM-DD."}), 400)
     if end_date:
         try:
             dt_end = datetime.strptime(end_date, "%Y-%m-%d").replace(
@@ -884,26 +2993,186 @@ def get_attendance():
             )
             query = query.where("timestamp", "<=", dt_end.isoformat())
         except ValueError:
-            return jsonify({"error": "Invalid end_date format. Use YYYY-MM-DD."}), 400
+            return None, (jsonify({"error": "Invalid end_date format. Use YYYY-MM-DD."}), 400)
+
+    return query, None
+
+class ChunkSink:
+    """
+    Write-only file object that collects written bytes until take() hands them out.
+    ZipFile writes to it as to an unseekable stream (sizes go in data descriptors).
+    """
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+XLSX_STATIC_PARTS = [
+    ("[Content_Types].xml",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ("_rels/.rels",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Target="xl/workbook.xml" '
+     'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+     '</Relationships>'),
+    ("xl/_rels/workbook.xml.rels",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+     'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+     '</Relationships>'),
+]
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+)
+XLSX_SHEET_HEAD = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+XLSX_SHEET_TAIL = b"</sheetData></worksheet>"
+XML_ILLEGAL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
 
-    results = query.stream()
-    out_list = []
-    for doc_ in results:
+def xlsx_cell(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return f"<c><v>{value!r}</v></c>"
+    text = XML_ILLEGAL_CHARS.sub("", "" if value is None else str(value))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{xml_escape(text)}</t></is></c>'
+
+def stream_xlsx(rows, sheet_name, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield a one-sheet .xlsx as it is written, so the first bytes go out while
+    `rows` is still being consumed. Cells are inline strings and numbers,
+    without styles; openpyxl and spreadsheet apps read it like any other workbook.
+    """
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, xml in XLSX_STATIC_PARTS:
+            archive.writestr(name, xml)
+        archive.writestr("xl/workbook.xml", XLSX_WORKBOOK.format(name=xml_escape(sheet_name)))
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(XLSX_SHEET_HEAD)
+            for row in rows:
+                sheet.write(("<row>" + "".join(xlsx_cell(v) for v in row) + "</row>").encode("utf-8"))
+                if sink.size >= chunk_size:
+                    yield sink.take()
+            sheet.write(XLSX_SHEET_TAIL)
+    yield sink.take()
+
+@app.route("/api/attendance", methods=["GET"])
+def get_attendance():
+    """
+    Without `limit`, returns every matching record as a JSON array.
+    With `limit`, returns one page: {records, next_cursor, has_more}.
+    Paging args: limit, start_after (a next_cursor token), order_by, order (asc/desc).
+    `fields` (comma-separated) projects the returned fields; doc_id is always included.
+    """
+    query, error = build_attendance_query(request.args)
+    if error:
+        return error
+
+    fields = [f.strip() for f in request.args.get("fields", "").split(",") if f.strip()]
+    unknown_fields = [f for f in fields if f not in ATTENDANCE_HEADERS]
+    if unknown_fields:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown_fields)}"}), 400
+    projected = [f for f in fields if f != "doc_id"]
+    if fields:
+        query = query.select(projected or ["student_id"])
+
+    def to_record(doc_):
         dd = doc_.to_dict()
+        if fields:
+            dd = {f: dd.get(f, "") for f in projected}
         dd["doc_id"] = doc_.id
-        out_list.append(dd)
+        return dd
 
-    return jsonify(out_list)
+    limit = request.args.get("limit")
+    if limit is None:
+        try:
+            return jsonify([to_record(doc_) for doc_ in stream_documents(query)])
+        except FailedPrecondition as e:
+            return missing_index_response(e)
+
+    try:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "limit must be a positive integer."}), 400
+    limit = min(limit, ATTENDANCE_MAX_PAGE_SIZE)
+
+    order_by = request.args.get("order_by", "timestamp")
+    order = request.args.get("order", "desc").lower()
+    if order_by not in ATTENDANCE_SORT_FIELDS:
+        return jsonify({"error": f"Cannot sort by '{order_by}'."}), 400
+    if order not in ("asc", "desc"):
+        return jsonify({"error": "order must be 'asc' or 'desc'."}), 400
+    if order_by != "timestamp" and (request.args.get("start_date") or request.args.get("end_date")):
+        # Firestore requires the first sort field to match a range filter
+        return jsonify({"error": "Only timestamp sorting is supported with a date range."}), 400
+
+    direction = firestore.Query.DESCENDING if order == "desc" else firestore.Query.ASCENDING
+    query = query.order_by(order_by, direction=direction)
+
+    start_after = request.args.get("start_after")
+    if start_after:
+        cursor_doc = get_document(db.collection("attendance").document(start_after))
+        if not cursor_doc.exists:
+            return jsonify({"error": "Invalid start_after cursor."}), 400
+        query = query.start_after(cursor_doc)
+
+    # Fetch one extra document to know whether another page exists
+    try:
+        docs = list(stream_documents(query.limit(limit + 1)))
+    except FailedPrecondition as e:
+        return missing_index_response(e)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+
+    return jsonify({
+        "records": [to_record(doc_) for doc_ in docs],
+        "next_cursor": docs[-1].id if has_more else None,
+        "has_more": has_more
+    })
 
 @app.route("/api/attendance/update", methods=["POST"])
 def update_attendance():
     data = request.json
-    records = data.get("records", [])
-    for rec in records:
-        doc_id = rec.get("doc_id")
-        if not doc_id:
+    records = [rec for rec in data.get("records", []) if rec.get("doc_id")]
+    refs = [db.collection("attendance").document(rec["doc_id"]) for rec in records]
+    old_docs = existing_records(refs)
+
+    writes = []
+    missing = []
+    for rec, ref in zip(records, refs):
+        old_doc = old_docs.get(rec["doc_id"])
+        if old_doc is None:
+            missing.append(rec["doc_id"])
             continue
-        ref = db.collection("attendance").document(doc_id)
         update_data = {
             "student_id": rec.get("student_id",""),
             "name": rec.get("name",""),
@@ -912,69 +3181,101 @@ def update_attendance():
             "timestamp": rec.get("timestamp",""),
             "status": rec.get("status","")
         }
-        ref.update(update_data)
+        writes.append((ref, update_data, True, old_doc, {**old_doc, **update_data}))
+
+    record_count = len(writes)
+    failed = len(commit_attendance_writes(writes))
+
+    if failed or missing:
+        return jsonify({
+            "message": f"Updated {record_count - failed} record(s); {failed} failed, {len(missing)} not found.",
+            "missing": missing
+        }), 500 if failed else 200
     return jsonify({"message": "Attendance records updated successfully."})
 
-@app.route("/api/attendance/download", methods=["GET"])
-def download_attendance_excel():
+@app.route("/api/attendance/summary", methods=["GET"])
+def attendance_summary():
+    """
+    PRESENT counts read from attendance_aggregates (one document per group).
+    group_by=subject_day (default): filters subject_id, start_date, end_date.
+    group_by=student_subject: filters student_id, subject_id.
+    """
+    group_by = request.args.get("group_by", "subject_day")
     student_id = request.args.get("student_id")
     subject_id = request.args.get("subject_id")
     start_date = request.args.get("start_date")
     end_date = request.args.get("end_date")
 
-    query = db.collection("attendance")
-    if student_id:
-        query = query.where("student_id", "==", student_id)
+    query = db.collection(AGGREGATES_COLLECTION).where("kind", "==", group_by)
+    if group_by == "subject_day":
+        if student_id:
+            return jsonify({"error": "student_id is not supported with group_by=subject_day."}), 400
+        for value in (start_date, end_date):
+            if value:
+                try:
+                    datetime.strptime(value, "%Y-%m-%d")
+                except ValueError:
+                    return jsonify({"error": "Invalid date format. Use YYYY-MM-DD."}), 400
+        if start_date:
+            query = query.where("day", ">=", start_date)
+        if end_date:
+            query = query.where("day", "<=", end_date)
+    elif group_by == "student_subject":
+        if start_date or end_date:
+            return jsonify({"error": "Date filters are not supported with group_by=student_subject."}), 400
+        if student_id:
+            query = query.where("student_id", "==", student_id)
+    else:
+        return jsonify({"error": "group_by must be 'subject_day' or 'student_subject'."}), 400
     if subject_id:
         query = query.where("subject_id", "==", subject_id)
-    if start_date:
-        try:
-            dt_start = datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.where("timestamp", ">=", dt_start.isoformat())
-        except ValueError:
-            return jsonify({"error": "Invalid start_date format. Use YYYY-MM-DD."}), 400
-    if end_date:
-        try:
-            dt_end = datetime.strptime(end_date, "%Y-%m-%d").replace(
-                hour=23, minute=59, second=59, microsecond=999999
-            )
-            query = query.where("timestamp", "<=", dt_end.isoformat())
-        except ValueError:
-            return jsonify({"error": "Invalid end_date format. Use YYYY-MM-DD."}), 400
 
-    results = query.stream()
-    att_list = []
-    for doc_ in results:
-        dd = doc_.to_dict()
-        dd["doc_id"] = doc_.id
-        att_list.append(dd)
+    groups = []
+    try:
+        for doc_ in stream_documents(query):
+            dd = doc_.to_dict()
+            if dd.get("count", 0) <= 0:
+                continue  # Groups whose records were all edited away
+            dd.pop("kind", None)
+            groups.append(dd)
+    except FailedPrecondition as e:
+        return missing_index_response(e)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Attendance"
-    headers = ["doc_id", "student_id", "name", "subject_id", "subject_name", "timestamp", "status"]
-    ws.append(headers)
-
-    for record in att_list:
-        row = [
-            record.get("doc_id",""),
-            record.get("student_id",""),
-            record.get("name",""),
-            record.get("subject_id",""),
-            record.get("subject_name",""),
-            record.get("timestamp",""),
-            record.get("status","")
-        ]
-        ws.append(row)
+    return jsonify({
+        "group_by": group_by,
+        "groups": groups,
+        "total": sum(g.get("count", 0) for g in groups)
+    })
 
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
-    return send_file(
-        output,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        as_attachment=True,
-        download_name="attendance.xlsx"
+@app.route("/api/attendance/download", methods=["GET"])
+def download_attendance_excel():
+    query, error = build_attendance_query(request.args)
+    if error:
+        return error
+
+    # The first fetch runs before the response starts, so a missing index
+    # still returns the JSON error instead of a truncated file
+    docs = iter(stream_documents(query))
+    try:
+        first = next(docs, None)
+    except FailedPrecondition as e:
+        return missing_index_response(e)
+
+    def rows():
+        yield ATTENDANCE_HEADERS
+        with metrics.time("attendance_stage_seconds", endpoint="export", stage="fetch_and_write_rows"):
+            for doc_ in itertools.chain([first] if first is not None else [], docs):
+                record = doc_.to_dict()
+                record["doc_id"] = doc_.id
+                yield [record.get(h, "") for h in ATTENDANCE_HEADERS]
+
+    # Rows go from the Firestore stream into the zip and out to the client as
+    # they are written: memory stays flat and the download starts at once.
+    # The length is unknown up front, so the body is sent chunked.
+    return Response(
+        stream_xlsx(rows(), "Attendance"),
+        mimetype=XLSX_MIMETYPE,
+        headers={"Content-Disposition": "attachment; filename=attendance.xlsx"}
     )
 
 @app.route("/api/attendance/template", methods=["GET"])
@@ -982,19 +3283,48 @@ def download_template():
     wb = Workbook()
     ws = wb.active
     ws.title = "Attendance Template"
-    headers = ["doc_id","student_id","name","subject_id","subject_name","timestamp","status"]
-    ws.append(headers)
+    ws.append(ATTENDANCE_HEADERS)
 
     output = io.BytesIO()
     wb.save(output)
     output.seek(0)
     return send_file(
         output,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        mimetype=XLSX_MIMETYPE,
         as_attachment=True,
         download_name="attendance_template.xlsx"
     )
 
+def parse_attendance_row(row):
+    """
+    Validate one uploaded template row.
+    Returns (doc_id, doc_data); raises ValueError with a readable reason.
+    """
+    row = tuple(row[:len(ATTENDANCE_HEADERS)]) + (None,) * (len(ATTENDANCE_HEADERS) - len(row))
+    doc_id, student_id, name, subject_id, subject_name, timestamp, status = row
+
+    if student_id in (None, ""):
+        raise ValueError("Missing student_id")
+    if doc_id and "/" in str(doc_id):
+        raise ValueError(f"Invalid doc_id '{doc_id}'")
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    elif timestamp:
+        try:
+            datetime.fromisoformat(str(timestamp))
+        except ValueError:
+            raise ValueError(f"Invalid timestamp '{timestamp}'")
+
+    doc_data = {
+        "student_id": str(student_id),
+        "name": str(name or ""),
+        "subject_id": str(subject_id or ""),
+        "subject_name": str(subject_name or ""),
+        "timestamp": str(timestamp or ""),
+        "status": str(status or "")
+    }
+    return (str(doc_id) if doc_id else None), doc_data
+
 @app.route("/api/attendance/upload", methods=["POST"])
 def upload_attendance_excel():
     if "file" not in request.files:
@@ -1004,87 +3334,395 @@ def upload_attendance_excel():
         return jsonify({"error": "Please upload a .xlsx file"}), 400
 
     try:
-        wb = openpyxl.load_workbook(file)
+        # Read-only mode streams rows instead of loading the whole sheet
+        with metrics.time("attendance_stage_seconds", endpoint="import", stage="load_workbook"):
+            wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
     except Exception as e:
         return jsonify({"error": f"Failed to read Excel file: {str(e)}"}), 400
 
-    ws = wb.active
-    rows = list(ws.iter_rows(values_only=True))
-    expected = ("doc_id","student_id","name","subject_id","subject_name","timestamp","status")
-    if not rows or rows[0] != expected:
-        return jsonify({"error": "Incorrect template format"}), 400
-
-    for row in rows[1:]:
-        doc_id, student_id, name, subject_id, subject_name, timestamp, status = row
-        if doc_id:
-            doc_data = {
-                "student_id": student_id or "",
-                "name": name or "",
-                "subject_id": subject_id or "",
-                "subject_name": subject_name or "",
-                "timestamp": timestamp or "",
-                "status": status or ""
-            }
-            db.collection("attendance").document(doc_id).set(doc_data, merge=True)
-        else:
-            new_doc = {
-                "student_id": student_id or "",
-                "name": name or "",
-                "subject_id": subject_id or "",
-                "subject_name": subject_name or "",
-                "timestamp": timestamp or "",
-                "status": status or ""
-            }
-            db.collection("attendance").add(new_doc)
+    imported = 0
+    skipped = 0
+    rows_processed = 0
+    errors = []
+    pending = []  # (row_number, (doc_ref, data, merge))
+
+    def flush():
+        with metrics.time("attendance_stage_seconds", endpoint="import", stage="write"):
+            write_pending()
+
+    def write_pending():
+        nonlocal imported
+        # Rows that overwrite an existing doc must first remove it from the aggregates
+        old_docs = existing_records([ref for _, (ref, _, merge) in pending if merge])
+        writes = []
+        for _, (ref, data, merge) in pending:
+            old_doc = old_docs.get(ref.id) if merge else None
+            writes.append((ref, data, merge, old_doc, {**(old_doc or {}), **data}))
+
+        failures = commit_attendance_writes(writes)
+        for i, error in failures:
+            errors.append({"row": pending[i][0], "error": f"Write failed: {error}"})
+        imported += len(pending) - len(failures)
+        pending.clear()
+
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None or tuple(header[:len(ATTENDANCE_HEADERS)]) != tuple(ATTENDANCE_HEADERS):
+            return jsonify({"error": "Incorrect template format"}), 400
+
+        for row_number, row in enumerate(rows, start=2):
+            if not any(cell not in (None, "") for cell in row):
+                skipped += 1
+                continue
+            rows_processed += 1
+            try:
+                doc_id, doc_data = parse_attendance_row(row)
+            except ValueError as e:
+                errors.append({"row": row_number, "error": str(e)})
+                continue
+
+            if doc_id:
+                pending.append((row_number, (db.collection("attendance").document(doc_id), doc_data, True)))
+            else:
+                pending.append((row_number, (db.collection("attendance").document(), doc_data, False)))
+
+            if len(pending) >= FIRESTORE_BATCH_LIMIT:
+                flush()
+                app.logger.info("Excel import: %d row(s) written, %d error(s) so far", imported, len(errors))
+
+        if pending:
+            flush()
+    finally:
+        wb.close()
 
-    return jsonify({"message": "Excel data imported successfully."})
+    return jsonify({
+        "message": f"Excel data imported: {imported} of {rows_processed} row(s) written, {len(errors)} error(s).",
+        "rows_processed": rows_processed,
+        "imported": imported,
+        "skipped_empty": skipped,
+        "errors": errors
+    }), 200
 
 # -----------------------------
 # 8) Gemini Chat Endpoint
 # -----------------------------
-@app.route("/process_prompt", methods=["POST"])
-def process_prompt():
-    data = request.json
-    user_prompt = data.get("prompt","").strip()
-    if not user_prompt:
-        return jsonify({"error":"No prompt provided"}), 400
+def estimate_tokens(text):
+    # Roughly 4 characters per token; close enough for budgeting without a tokenizer call
+    return len(text) // 4 + 1
+
+class ChatSession:
+    """
+    Chat memory of one session: a sliding window of the newest messages that
+    fits CHAT_TOKEN_BUDGET and MAX_MEMORY. The history text is kept and
+    updated per message (appended, and trimmed from the front) instead of
+    being rebuilt from every message on each call.
+    """
+    ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+
+    def __init__(self, token_budget=CHAT_TOKEN_BUDGET, max_messages=MAX_MEMORY):
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.messages = deque()  # (line_length, tokens) of each message in history
+        self.tokens = 0
+        self.history = ""
+        self.lock = threading.Lock()
+
+    def add(self, role, content):
+        line = f"{self.ROLE_LABELS[role]}: {content}\n"
+        tokens = estimate_tokens(line)
+        self.messages.append((len(line), tokens))
+        self.history += line
+        self.tokens += tokens
+
+        # Drop the oldest messages, always keeping the newest one
+        dropped = 0
+        while len(self.messages) > 1 and (self.tokens > self.token_budget or len(self.messages) > self.max_messages):
+            length, tokens = self.messages.popleft()
+            dropped += length
+            self.tokens -= tokens
+        if dropped:
+            self.history = self.history[dropped:]
+
+    def prompt(self):
+        return SYSTEM_PROMPT + self.history
+
+chat_sessions = TTLCache(CHAT_MAX_SESSIONS, CHAT_SESSION_TTL)
+chat_sessions_lock = threading.Lock()
+
+def chat_session(session_id=None):
+    """
+    Return (session_id, ChatSession), starting a new session when the id is
+    missing or has expired. Each use refreshes the session's TTL.
+    """
+    with chat_sessions_lock:
+        session = chat_sessions.get(session_id) if session_id else None
+        if session is None:
+            session_id = uuid.uuid4().hex
+            session = ChatSession()
+        chat_sessions.put(session_id, session)
+    return session_id, session
+
+def chat_prompt(session, user_prompt):
+    """
+    Add the user message to the session memory and return the prompt.
+    """
+    with session.lock:
+        session.add("user", user_prompt)
+        return session.prompt()
 
-    # Add user message
-    conversation_memory.append({"role":"user","content":user_prompt})
+def response_text(response):
+    if not response.candidates:
+        return ""
+    return "".join(part.text for part in response.candidates[0].content.parts)
 
-    # Build conversation string
-    conv_str = ""
-    for msg in conversation_memory:
-        if msg["role"] == "system":
-            conv_str += f"System: {msg['content']}\n"
-        elif msg["role"] == "user":
-            conv_str += f"User: {msg['content']}\n"
-        else:
-            conv_str += f"Assistant: {msg['content']}\n"
+CHAT_FALLBACK_REPLY = "Hmm, I'm having trouble responding right now."
+CHAT_ERROR_PREFIX = "Error generating response: "
 
-    # Call Gemini
+def chat_generate(conv_str):
+    """
+    Call Gemini (blocking); errors are turned into the reply text.
+    """
     try:
-        response = model.generate_content(conv_str)
+        with cloud_call("gemini", "generate_content"):
+            response = model.generate_content(conv_str)
     except Exception as e:
-        assistant_reply = f"Error generating response: {str(e)}"
-    else:
-        if not response.candidates:
-            assistant_reply = "Hmm, I'm having trouble responding right now."
-        else:
-            parts = response.candidates[0].content.parts
-            assistant_reply = "".join(part.text for part in parts).strip()
+        return f"{CHAT_ERROR_PREFIX}{str(e)}"
+    return response_text(response).strip() or CHAT_FALLBACK_REPLY
+
+def chat_stream(conv_str):
+    """
+    Call Gemini with streaming and yield the reply text as it arrives;
+    an error ends the stream with the error as text.
+    """
+    started = time.perf_counter()
+    first_chunk = True
+    try:
+        with cloud_call("gemini", "generate_content_stream"):
+            for chunk in model.generate_content(conv_str, stream=True):
+                if first_chunk:
+                    first_chunk = False
+                    metrics.observe("attendance_stage_seconds", time.perf_counter() - started,
+                                    endpoint="process_prompt", stage="first_chunk")
+                text = response_text(chunk)
+                if text:
+                    yield text
+    except Exception as e:
+        yield f"{CHAT_ERROR_PREFIX}{str(e)}"
+
+def chat_remember(session, assistant_reply, user_prompt=None):
+    """
+    Add the assistant reply to the session memory, preceded by the user
+    prompt when it was not added by chat_prompt (cached replies).
+    """
+    with session.lock:
+        if user_prompt is not None:
+            session.add("user", user_prompt)
+        session.add("assistant", assistant_reply)
+
+def normalize_prompt(prompt):
+    """
+    Lowercase, drop punctuation and collapse whitespace, so "How do I register?"
+    and "how do i register" share a cache entry.
+    """
+    return " ".join(re.sub(r"[^\w\s]", " ", prompt.lower()).split())
+
+class ChatResponseCache(TTLCache):
+    """
+    Chat replies keyed by the normalized prompt. Pre-seeded FAQ answers never
+    expire or get evicted; generated replies follow the TTL/LRU rules.
+    FAQ hits count as cache hits.
+    """
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.faq = {}
+
+    def seed(self, answers):
+        with self._lock:
+            self.faq.update({normalize_prompt(question): answer for question, answer in answers.items()})
+
+    def get(self, key):
+        with self._lock:
+            answer = self.faq.get(key)
+            if answer is not None:
+                self.hits += 1
+                return answer
+        return super().get(key)
+
+    def stats(self):
+        stats = super().stats()
+        stats["faq_size"] = len(self.faq)
+        return stats
+
+# Built-in answers to the most common questions; CHAT_FAQ_FILE adds more or overrides these
+CHAT_FAQ = {
+    "How do I register?": (
+        "Open the Register tab, enter the student's name and ID, choose a clear photo "
+        "with one face and press Register. For a whole class, POST a ZIP of photos to /register/bulk."
+    ),
+    "How do I register a student?": (
+        "Open the Register tab, enter the student's name and ID, choose a clear photo "
+        "with one face and press Register. For a whole class, POST a ZIP of photos to /register/bulk."
+    ),
+    "How do I take attendance?": (
+        "Open the Recognize tab, pick the subject, upload a class photo and press Recognize. "
+        "Every recognized student is marked PRESENT for that subject."
+    ),
+    "How do I export Excel?": (
+        "Open the Attendance tab, set the filters you want and press Download Excel. "
+        "The file has the columns of the attendance table."
+    ),
+    "How do I import Excel?": (
+        "Open the Attendance tab, download the template, fill in the rows and upload it. "
+        "Rows with errors are listed after the upload; the others are saved."
+    ),
+    "How do I add a subject?": "Open the Subjects tab, type the subject name and press Add Subject.",
+}
+
+chat_response_cache = ChatResponseCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+chat_response_cache.seed(CHAT_FAQ)
+if CHAT_FAQ_FILE:
+    try:
+        with open(CHAT_FAQ_FILE, encoding="utf-8") as f:
+            chat_response_cache.seed(json.load(f))
+    except (OSError, ValueError) as e:
+        print(f"Chat FAQ file '{CHAT_FAQ_FILE}' not loaded: {e}")
+
+def chat_first_turn(session):
+    """
+    True while the session has no history. Only first-turn replies are served
+    from or stored in the cache: later replies depend on (and would reveal)
+    the session's conversation, which the cache key does not include.
+    """
+    with session.lock:
+        return not session.messages
+
+def chat_cached_reply(user_prompt):
+    return chat_response_cache.get(normalize_prompt(user_prompt))
+
+def chat_cache_reply(user_prompt, assistant_reply):
+    """
+    Cache a generated reply, unless it is an error or the fallback text.
+    """
+    if CHAT_ERROR_PREFIX in assistant_reply or assistant_reply == CHAT_FALLBACK_REPLY:
+        return
+    chat_response_cache.put(normalize_prompt(user_prompt), assistant_reply)
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
 
-    # Add assistant reply
-    conversation_memory.append({"role":"assistant","content":assistant_reply})
+def wants_event_stream(stream_arg, accept_header):
+    return stream_arg in ("1", "true") or "text/event-stream" in (accept_header or "")
 
-    if len(conversation_memory) > MAX_MEMORY:
-        conversation_memory.pop(0)
+@app.route("/process_prompt", methods=["POST"])
+def process_prompt():
+    """
+    JSON: {"prompt": ..., "session_id": optional}. Replies with JSON, or with
+    server-sent events when called with ?stream=1 (or Accept: text/event-stream):
+    a "session" event, one unnamed event per text chunk, then a "done" event
+    with the full reply. On a session's first turn, cached and FAQ replies
+    skip Gemini entirely.
+    """
+    data = request.get_json(silent=True) or {}
+    user_prompt = str(data.get("prompt", "")).strip()
+    if not user_prompt:
+        return jsonify({"error":"No prompt provided"}), 400
 
-    return jsonify({"message": assistant_reply})
+    session_id, session = chat_session(data.get("session_id"))
+    stream = wants_event_stream(request.args.get("stream"), request.headers.get("Accept"))
+
+    first_turn = chat_first_turn(session)
+    cached_reply = chat_cached_reply(user_prompt) if first_turn else None
+    metrics.inc("attendance_chat_replies_total", source="cache" if cached_reply is not None else "gemini")
+    if cached_reply is not None:
+        chat_remember(session, cached_reply, user_prompt)
+        if stream:
+            events = [
+                sse_event({"session_id": session_id}, "session"),
+                sse_event({"text": cached_reply}),
+                sse_event({"message": cached_reply}, "done")
+            ]
+            return Response(events, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+        return jsonify({"message": cached_reply, "session_id": session_id, "cached": True})
+
+    conv_str = chat_prompt(session, user_prompt)
+
+    if stream:
+        def events():
+            yield sse_event({"session_id": session_id}, "session")
+            chunks = []
+            for text in chat_stream(conv_str):
+                chunks.append(text)
+                yield sse_event({"text": text})
+            assistant_reply = "".join(chunks).strip() or CHAT_FALLBACK_REPLY
+            chat_remember(session, assistant_reply)
+            if first_turn:
+                chat_cache_reply(user_prompt, assistant_reply)
+            yield sse_event({"message": assistant_reply}, "done")
+
+        # X-Accel-Buffering stops proxies (nginx) from holding back the chunks
+        return Response(events(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    with metrics.time("attendance_stage_seconds", endpoint="process_prompt", stage="generate"):
+        assistant_reply = chat_generate(conv_str)
+    chat_remember(session, assistant_reply)
+    if first_turn:
+        chat_cache_reply(user_prompt, assistant_reply)
+
+    return jsonify({"message": assistant_reply, "session_id": session_id, "cached": False})
 
 # -----------------------------
 # 9) Run App
 # -----------------------------
+# Build the cloud clients in a background thread at startup (0: on first use)
+APP_WARMUP = os.getenv("APP_WARMUP", "1") == "1"
+
+LAZY_CLIENTS = (rekognition_client._client, db, model)
+
+startup_timings["module_load_ms"] = round((time.perf_counter() - MODULE_LOAD_STARTED) * 1000, 1)
+
+def warm_up():
+    """
+    Build every client (and start the subjects listener) so the first
+    requests do not pay for it. A failing client is retried on first use.
+    """
+    started = time.perf_counter()
+    for client in LAZY_CLIENTS:
+        try:
+            client.get()
+        except Exception as e:
+            print(f"Warm-up of {client.name} failed: {e}")
+    if SUBJECTS_LISTENER:
+        start_subjects_listener_or_ttl()
+    startup_timings["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    print(f"Warm-up finished in {startup_timings['warmup_ms']} ms.")
+
+_app_created = False
+_app_created_lock = threading.Lock()
+
+def create_app():
+    """
+    Application factory: returns the Flask app, ready to serve, without
+    touching the network. Clients are built lazily, per process, or ahead
+    of the first request by a background warm-up (APP_WARMUP).
+    Safe to call more than once.
+      gunicorn "app:create_app()"
+    """
+    global _app_created
+    with _app_created_lock:
+        if not _app_created:
+            _app_created = True
+            if APP_WARMUP:
+                threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+            elif SUBJECTS_LISTENER:
+                # The listener builds the Firestore client, so start it off the startup path
+                threading.Thread(target=start_subjects_listener_or_ttl, name="subjects-listener", daemon=True).start()
+            startup_timings["ready_ms"] = round((time.perf_counter() - MODULE_LOAD_STARTED) * 1000, 1)
+            print(f"App ready in {startup_timings['ready_ms']} ms.")
+    return app
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,227 @@
+"""
+Async (ASGI) serving mode for the attendance app:
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+POST /recognize, /register and /process_prompt run as coroutines. Each blocking
+step (image decoding, Rekognition, Firestore and Gemini calls) is awaited on one
+shared, bounded executor, so an in-flight request only holds a thread while one
+of its calls is running, and the face searches of a group photo are awaited
+concurrently. Every other route is served by the Flask app through asgiref.
+
+The websocket /stream/ws receives live camera frames as binary messages and
+answers each with the stream state as JSON (see StreamSession in app.py).
+"""
+import asyncio
+import functools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.test import EnvironBuilder
+
+import app as attendance
+
+flask_app = attendance.create_app()
+wsgi_app = WsgiToAsgi(flask_app)
+
+# Threads shared by the blocking calls of all in-flight requests
+ASGI_BLOCKING_WORKERS = int(os.getenv("ASGI_BLOCKING_WORKERS", "32"))
+blocking_executor = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix="asgi-blocking")
+
+async def run_blocking(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args))
+
+# -----------------------------
+# Request / Response helpers
+# -----------------------------
+async def read_body(receive, limit):
+    """
+    Read the whole request body; returns None once it exceeds `limit` bytes.
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("Client disconnected")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if limit and size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+def read_upload(scope, body):
+    """
+    Parse an upload with the same rules as the Flask routes (read_uploaded_image).
+    """
+    builder = EnvironBuilder(
+        path=scope["path"],
+        method=scope["method"],
+        headers=[(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]],
+        query_string=scope.get("query_string", b"").decode("latin-1"),
+        data=body
+    )
+    with flask_app.request_context(builder.get_environ()):
+        return attendance.read_uploaded_image()
+
+async def send_json(send, payload, status=200):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("ascii"))
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+# -----------------------------
+# Async routes
+# -----------------------------
+async def recognize(scope, body):
+    try:
+        data, image_bytes = await run_blocking(read_upload, scope, body)
+    except ValueError:
+        return {"message": "Invalid image data"}, 400
+
+    job, error = await run_blocking(attendance.prepare_recognition, data, image_bytes)
+    if error:
+        return error
+
+    try:
+        faces = await run_blocking(attendance.detect_job_faces, job)
+    except Exception as e:
+        return {"message": f"Failed to detect faces: {str(e)}"}, 500
+    if not faces:
+        return attendance.recognition_payload(job, faces), 200
+
+    # Search all faces concurrently, at most SEARCH_MAX_WORKERS at a time (order is preserved)
+    face_crops = attendance.crop_job_faces(job, faces)
+    search_slots = asyncio.Semaphore(attendance.SEARCH_MAX_WORKERS)
+
+    async def search(idx, face_crop):
+        async with search_slots:
+            return await run_blocking(attendance.search_face, idx, face_crop)
+
+    with attendance.metrics.time("attendance_stage_seconds", endpoint="recognize", stage="search"):
+        identified_people = list(await asyncio.gather(*(search(i, c) for i, c in enumerate(face_crops))))
+    attendance_log = await run_blocking(attendance.log_attendance, job, identified_people)
+    return attendance.recognition_payload(job, faces, identified_people, attendance_log), 200
+
+async def register(scope, body):
+    try:
+        data, image_bytes = await run_blocking(read_upload, scope, body)
+    except ValueError:
+        return {"message": "Invalid image data"}, 400
+    return await run_blocking(attendance.run_registration, data, image_bytes)
+
+async def process_prompt(scope, body):
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        return {"error": "Invalid JSON body"}, 400
+    user_prompt = str(data.get("prompt", "")).strip()
+    if not user_prompt:
+        return {"error": "No prompt provided"}, 400
+
+    session_id, session = attendance.chat_session(data.get("session_id"))
+    first_turn = attendance.chat_first_turn(session)
+    cached_reply = attendance.chat_cached_reply(user_prompt) if first_turn else None
+    attendance.metrics.inc("attendance_chat_replies_total", source="cache" if cached_reply is not None else "gemini")
+    if cached_reply is not None:
+        attendance.chat_remember(session, cached_reply, user_prompt)
+        return {"message": cached_reply, "session_id": session_id, "cached": True}, 200
+
+    conv_str = attendance.chat_prompt(session, user_prompt)
+    assistant_reply = await run_blocking(attendance.chat_generate, conv_str)
+    attendance.chat_remember(session, assistant_reply)
+    if first_turn:
+        attendance.chat_cache_reply(user_prompt, assistant_reply)
+    return {"message": assistant_reply, "session_id": session_id, "cached": False}, 200
+
+async def stream_websocket(scope, receive, send):
+    """
+    One live stream per connection: ?subject_id=...&attendance_session=...
+    The first message sent is {"stream_id": ...}; each binary frame received
+    is answered with the stream state. The stream ends with the connection.
+    """
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+    await send({"type": "websocket.accept"})
+
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    session = attendance.start_stream_session({key: values[0] for key, values in query.items()})
+    if session is None:
+        await send({"type": "websocket.send", "text": json.dumps({"error": "Too many live streams are running. Try again later."})})
+        await send({"type": "websocket.close", "code": 1013})  # Try Again Later
+        return
+    await send({"type": "websocket.send", "text": json.dumps({"stream_id": session.id})})
+    try:
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            frame = message.get("bytes")
+            if not frame:
+                continue
+            try:
+                state = await run_blocking(session.process_frame, frame)
+            except ValueError:
+                state = {"error": "Invalid image data"}
+            except Exception as e:
+                state = {"error": f"Failed to process frame: {str(e)}"}
+            await send({"type": "websocket.send", "text": json.dumps(state)})
+    finally:
+        attendance.stream_sessions.discard(session.id)
+
+ASYNC_ROUTES = {
+    "/recognize": recognize,
+    "/register": register,
+    "/process_prompt": process_prompt,
+}
+
+# Flask endpoint names, so /metrics labels are the same in both serving modes
+ASYNC_ENDPOINTS = {path: flask_app.url_map.bind("localhost").match(path, method="POST")[0] for path in ASYNC_ROUTES}
+
+def served_by_flask(scope):
+    """
+    POST /recognize?async=1 is queued by the Flask route's job pool, and
+    streamed chat replies (server-sent events) are streamed by the Flask route.
+    """
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if query.get("async", [""])[0] in ("1", "true"):
+        return True
+    accept = dict(scope.get("headers") or []).get(b"accept", b"").decode("latin-1")
+    return attendance.wants_event_stream(query.get("stream", [""])[0], accept)
+
+async def app(scope, receive, send):
+    if scope["type"] == "websocket":
+        if scope.get("path") == "/stream/ws":
+            await stream_websocket(scope, receive, send)
+        else:
+            await send({"type": "websocket.close", "code": 1000})
+        return
+    route = ASYNC_ROUTES.get(scope.get("path")) if scope["type"] == "http" else None
+    if route is None or scope["method"] != "POST" or served_by_flask(scope):
+        await wsgi_app(scope, receive, send)
+        return
+
+    body = await read_body(receive, flask_app.config.get("MAX_CONTENT_LENGTH"))
+    if body is None:
+        await send_json(send, {"message": f"Upload too large. The maximum request size is {attendance.MAX_UPLOAD_MB:g} MB."}, 413)
+        return
+    started = time.perf_counter()
+    payload, status = await route(scope, body)
+    await send_json(send, payload, status)
+    endpoint = ASYNC_ENDPOINTS[scope["path"]]
+    attendance.metrics.observe("attendance_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+    attendance.metrics.inc("attendance_requests_total", endpoint=endpoint, method="POST", status=status)
@@ -0,0 +1,237 @@
+"""
+Offline endpoint benchmark: runs /recognize, /register, the Excel export and
+import, the attendance page and /process_prompt against the local fakes in
+fakes.py, and reports p50/p95/p99 latency, throughput and peak Python memory
+per endpoint. No cloud credentials are needed.
+
+Run from attendancev1/:  python benchmarks/bench_endpoints.py --help
+e.g.  python benchmarks/bench_endpoints.py --requests 50 --concurrency 8 --faces 40 --rekognition-ms 80
+
+Latency and throughput come from a timed pass; peak memory (tracemalloc, which
+includes numpy buffers) from a separate, shorter pass so tracing does not skew
+the timings. --json writes the results, and --baseline compares p95 against a
+previous --json file and exits with status 1 on a regression.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fakes import (FakeFirestore, FakeGemini, FakeRekognition, Latency,
+                   synthetic_attendance, synthetic_group_photo)
+
+ENDPOINTS = ("recognize", "register", "attendance_page", "export", "import", "chat")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="Comma-separated subset of: " + ", ".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=20, help="Timed requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once")
+    parser.add_argument("--faces", type=int, default=30, help="Faces per synthetic group photo")
+    parser.add_argument("--photo-size", default="3000x2000", help="Group photo WIDTHxHEIGHT")
+    parser.add_argument("--detection-mode", choices=("full", "tiled"), default="full")
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--records", type=int, default=5000, help="Attendance records in the synthetic dataset")
+    parser.add_argument("--rekognition-ms", type=float, default=50.0, help="Mean Rekognition latency per call")
+    parser.add_argument("--firestore-ms", type=float, default=20.0, help="Mean Firestore latency per RPC")
+    parser.add_argument("--gemini-ms", type=float, default=800.0, help="Mean Gemini latency per reply")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency jitter as a fraction of the mean")
+    parser.add_argument("--rekognition-errors", type=float, default=0.0, help="Fraction of Rekognition calls throttled")
+    parser.add_argument("--firestore-errors", type=float, default=0.0, help="Fraction of Firestore RPCs failing")
+    parser.add_argument("--gemini-errors", type=float, default=0.0, help="Fraction of Gemini calls failing")
+    parser.add_argument("--rekognition-tps", default="0", help="REKOGNITION_TPS for the run (0: no client-side limit)")
+    parser.add_argument("--with-caches", action="store_true", help="Keep the face search and chat caches enabled")
+    parser.add_argument("--memory-requests", type=int, default=None, help="Requests in the memory pass (default: 2 x concurrency)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare p95 against this --json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 increase over the baseline (0.2 = 20%%)")
+    return parser.parse_args()
+
+def configure_environment(args):
+    """
+    Settings read by app.py at import time.
+    """
+    os.environ["APP_WARMUP"] = "0"
+    os.environ["REKOGNITION_TPS"] = str(args.rekognition_tps)
+    os.environ["REKOGNITION_BACKOFF_BASE"] = "0.01"
+    if not args.with_caches:
+        # Every request repeats the same photos and prompts; caching would hide the work being measured
+        os.environ["FACE_CACHE_SIZE"] = "0"
+        os.environ["CHAT_CACHE_SIZE"] = "0"
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def run_requests(send, count, concurrency):
+    """
+    Call send(i) for i in range(count) on `concurrency` threads.
+    Returns (latencies_ms, errors, wall_seconds); a non-2xx status is an error.
+    """
+    def timed(i):
+        started = time.perf_counter()
+        status = send(i)
+        return (time.perf_counter() - started) * 1000, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(count)))
+    wall = time.perf_counter() - started
+    latencies = sorted(ms for ms, _ in results)
+    errors = sum(1 for _, status in results if not 200 <= status < 300)
+    return latencies, errors, wall
+
+def measure(name, send, args):
+    send(0)  # Warm-up: lazy imports, LUTs, first connections
+
+    latencies, errors, wall = run_requests(send, args.requests, args.concurrency)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    run_requests(send, args.memory_requests or 2 * args.concurrency, args.concurrency)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "endpoint": name,
+        "requests": args.requests,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "throughput_rps": round(args.requests / wall, 2),
+        "peak_memory_mb": round(peak / (1024 * 1024), 1),
+    }
+
+def build_senders(client, args):
+    """
+    One send(i) -> status function per endpoint.
+    """
+    width, height = (int(v) for v in args.photo_size.lower().split("x"))
+    group_photos = [synthetic_group_photo(width, height, args.faces, seed=seed) for seed in range(4)]
+    portrait = synthetic_group_photo(640, 800, 1, seed=99)
+
+    def recognize(i):
+        response = client.post("/recognize", content_type="multipart/form-data", data={
+            "image": (io.BytesIO(group_photos[i % len(group_photos)]), "class.jpg"),
+            "subject_id": "subject0",
+            "detection_mode": args.detection_mode,
+        })
+        return response.status_code
+
+    def register(i):
+        response = client.post("/register", content_type="multipart/form-data", data={
+            "image": (io.BytesIO(portrait), "student.jpg"),
+            "name": f"Bench{i}",
+            "student_id": f"B{i:06d}",
+        })
+        return response.status_code
+
+    def attendance_page(i):
+        return client.get("/api/attendance?limit=50&order_by=timestamp&order=desc").status_code
+
+    def export(i):
+        response = client.get("/api/attendance/download")
+        response.get_data()  # Drain the streamed workbook
+        return response.status_code
+
+    workbook = None
+
+    def import_(i):
+        nonlocal workbook
+        if workbook is None:
+            workbook = client.get("/api/attendance/download").get_data()
+        response = client.post("/api/attendance/upload", content_type="multipart/form-data", data={
+            "file": (io.BytesIO(workbook), "attendance.xlsx"),
+        })
+        return response.status_code
+
+    def chat(i):
+        response = client.post("/process_prompt", json={"prompt": f"Benchmark question {i} {time.perf_counter_ns()}"})
+        return response.status_code
+
+    return {
+        "recognize": recognize,
+        "register": register,
+        "attendance_page": attendance_page,
+        "export": export,
+        "import": import_,
+        "chat": chat,
+    }
+
+def print_table(results):
+    header = f"{'endpoint':<16}{'reqs':>6}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'peak MB':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['endpoint']:<16}{r['requests']:>6}{r['errors']:>8}{r['p50_ms']:>10}{r['p95_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['throughput_rps']:>9}{r['peak_memory_mb']:>10}")
+
+def compare_to_baseline(results, path, tolerance):
+    """
+    Print every endpoint whose p95 grew by more than `tolerance`; returns True if any did.
+    """
+    with open(path, encoding="utf-8") as f:
+        baseline = {r["endpoint"]: r for r in json.load(f)["results"]}
+    regressed = False
+    for r in results:
+        old = baseline.get(r["endpoint"])
+        if old and old["p95_ms"] > 0 and r["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressed = True
+            print(f"REGRESSION {r['endpoint']}: p95 {old['p95_ms']} ms -> {r['p95_ms']} ms")
+    return regressed
+
+def main():
+    args = parse_args()
+    selected = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(selected) - set(ENDPOINTS)
+    if unknown:
+        sys.exit(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+    configure_environment(args)
+    import app as attendance
+
+    jitter = args.jitter
+    rekognition = FakeRekognition(
+        Latency(args.rekognition_ms, args.rekognition_ms * jitter, args.rekognition_errors),
+        faces_per_photo=args.faces, students=args.students
+    )
+    db = FakeFirestore(Latency(args.firestore_ms, args.firestore_ms * jitter, args.firestore_errors))
+    gemini = FakeGemini(Latency(args.gemini_ms, args.gemini_ms * jitter, args.gemini_errors))
+    fakes = {"rekognition": rekognition, "firestore": db, "gemini": gemini}
+    for lazy in attendance.LAZY_CLIENTS:
+        lazy.set(fakes[lazy.name])
+
+    synthetic_attendance(db, args.records, students=args.students)
+    client = attendance.app.test_client()
+    senders = build_senders(client, args)
+
+    print(f"{args.requests} requests per endpoint, concurrency {args.concurrency}, "
+          f"{args.faces} faces per {args.photo_size} photo ({args.detection_mode}), {args.records} attendance records")
+    print(f"Latency: Rekognition {args.rekognition_ms} ms, Firestore {args.firestore_ms} ms, Gemini {args.gemini_ms} ms "
+          f"(+/- {jitter:.0%})\n")
+
+    results = [measure(name, senders[name], args) for name in selected]
+    print_table(results)
+    print(f"\nRekognition: {json.dumps(attendance.rekognition_client.stats())}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.baseline and compare_to_baseline(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
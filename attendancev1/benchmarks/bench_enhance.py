@@ -0,0 +1,48 @@
+"""
+Micro-benchmark: enhance_image (lookup table, in place) against the original
+RGB->BGR, convertScaleAbs, BGR->RGB implementation.
+
+Run from attendancev1/:  python benchmarks/bench_enhance.py
+(importing app needs no credentials: the cloud clients are only built on first use).
+"""
+import os
+import sys
+import timeit
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import enhance_image, ENHANCE_ALPHA, ENHANCE_BETA
+
+FRAMES = {
+    "4K (3840x2160)": (2160, 3840),
+    "12 MP (4000x3000)": (3000, 4000),
+}
+REPEAT = 20
+
+def original_enhance(rgb_image):
+    cv_image = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
+    enhanced = cv2.convertScaleAbs(cv_image, alpha=ENHANCE_ALPHA, beta=ENHANCE_BETA)
+    return cv2.cvtColor(enhanced, cv2.COLOR_BGR2RGB)
+
+def best_ms(func, image):
+    return min(timeit.repeat(lambda: func(image), number=1, repeat=REPEAT)) * 1000
+
+def main():
+    rng = np.random.default_rng(0)
+    for label, (height, width) in FRAMES.items():
+        image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+        expected = original_enhance(image)
+        assert np.array_equal(enhance_image(image, in_place=False), expected), "LUT output differs"
+
+        original = best_ms(original_enhance, image)
+        lut_copy = best_ms(lambda img: enhance_image(img, in_place=False), image)
+        lut_in_place = best_ms(enhance_image, image.copy())
+        print(f"{label}: original {original:.1f} ms, "
+              f"LUT {lut_copy:.1f} ms ({original / lut_copy:.1f}x), "
+              f"LUT in place {lut_in_place:.1f} ms ({original / lut_in_place:.1f}x)")
+
+if __name__ == "__main__":
+    main()
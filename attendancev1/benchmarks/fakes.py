@@ -0,0 +1,404 @@
+"""
+Local stand-ins for Rekognition, Firestore and Gemini, plus synthetic data,
+so the endpoints can be benchmarked without cloud accounts.
+
+Each fake sleeps for a configurable latency per call and can inject errors:
+Rekognition raises botocore ClientErrors (ThrottlingException by default, which
+the app's retry layer handles), Firestore and Gemini raise plain exceptions.
+Only the client methods app.py uses are implemented.
+"""
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+from botocore.exceptions import ClientError
+from google.cloud.firestore_v1.transforms import Increment
+
+class Latency:
+    """
+    Per-call latency (mean_ms +/- jitter_ms, uniform) and error injection.
+    """
+    def __init__(self, mean_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def wait(self):
+        delay_ms = self.mean_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+# -----------------------------
+# Synthetic data
+# -----------------------------
+def face_grid(faces):
+    """
+    Normalized (Left, Top, Width, Height) boxes of `faces` faces laid out in a
+    grid, as in a class photo. Shared by the photo generator and FakeRekognition.
+    """
+    if faces <= 0:
+        return []
+    cols = int(np.ceil(np.sqrt(faces * 4 / 3)))
+    rows = int(np.ceil(faces / cols))
+    cell_w, cell_h = 1 / cols, 1 / rows
+    boxes = []
+    for i in range(faces):
+        row, col = divmod(i, cols)
+        boxes.append((col * cell_w + cell_w * 0.25, row * cell_h + cell_h * 0.15, cell_w * 0.5, cell_h * 0.7))
+    return boxes
+
+def synthetic_group_photo(width, height, faces, seed=0, quality=90):
+    """
+    JPEG bytes of a noisy background with `faces` face-like ellipses (with eyes)
+    at the face_grid positions. The noise keeps the JPEG size realistic.
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.integers(60, 200, size=(height, width, 3), dtype=np.uint8)
+    for left, top, w, h in face_grid(faces):
+        center = (int((left + w / 2) * width), int((top + h / 2) * height))
+        axes = (max(1, int(w * width / 2)), max(1, int(h * height / 2)))
+        skin = tuple(int(c) for c in rng.integers(120, 230, size=3))
+        cv2.ellipse(image, center, axes, 0, 0, 360, skin, -1)
+        for dx in (-axes[0] // 3, axes[0] // 3):
+            cv2.circle(image, (center[0] + dx, center[1] - axes[1] // 4), max(1, axes[0] // 8), (30, 30, 30), -1)
+    ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buf.tobytes()
+
+def synthetic_attendance(db, records, students=200, subjects=10, days=30, seed=0):
+    """
+    Fill the fake db's attendance collection with `records` random records
+    (and the subjects collection with `subjects` subjects).
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    for s in range(subjects):
+        db.store["subjects"][f"subject{s}"] = {"name": f"Subject {s}"}
+    for i in range(records):
+        student = rng.randrange(students)
+        subject = rng.randrange(subjects)
+        timestamp = start + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))
+        db.store["attendance"][f"rec{i}"] = {
+            "student_id": f"S{student:05d}",
+            "name": f"Student {student}",
+            "timestamp": timestamp.isoformat(),
+            "subject_id": f"subject{subject}",
+            "subject_name": f"Subject {subject}",
+            "status": "PRESENT" if rng.random() < 0.9 else "ABSENT"
+        }
+
+# -----------------------------
+# Rekognition
+# -----------------------------
+class FakeRekognition:
+    """
+    detect_faces returns `faces_per_photo` face_grid boxes; search_faces_by_image
+    matches one of `students` registered students with probability match_rate.
+    """
+    class exceptions:
+        class ResourceAlreadyExistsException(Exception):
+            pass
+
+    def __init__(self, latency, faces_per_photo=30, students=200, match_rate=0.9, error_code="ThrottlingException"):
+        self.latency = latency
+        self.faces_per_photo = faces_per_photo
+        self.students = students
+        self.match_rate = match_rate
+        self.error_code = error_code
+        self.indexed = []
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        self.latency.wait()
+        if self.latency.should_fail():
+            raise ClientError({"Error": {"Code": self.error_code, "Message": "Injected error"}}, operation)
+
+    def create_collection(self, CollectionId):
+        self._call("CreateCollection")
+
+    def detect_faces(self, Image, Attributes=None):
+        self._call("DetectFaces")
+        return {"FaceDetails": [
+            {"BoundingBox": {"Left": left, "Top": top, "Width": w, "Height": h}, "Confidence": 99.9}
+            for left, top, w, h in face_grid(self.faces_per_photo)
+        ]}
+
+    def search_faces_by_image(self, CollectionId, Image, MaxFaces=1, FaceMatchThreshold=None):
+        self._call("SearchFacesByImage")
+        if random.random() >= self.match_rate:
+            return {"FaceMatches": []}
+        student = random.randrange(self.students)
+        return {"FaceMatches": [
+            {"Similarity": 99.0, "Face": {"ExternalImageId": f"Student{student}_S{student:05d}", "Confidence": 99.9}}
+        ]}
+
+    def index_faces(self, CollectionId, Image, ExternalImageId, **kwargs):
+        self._call("IndexFaces")
+        with self._lock:
+            self.indexed.append(ExternalImageId)
+        return {"FaceRecords": [{"Face": {"ExternalImageId": ExternalImageId}}]}
+
+    def list_faces(self, CollectionId, MaxResults=1000, NextToken=None):
+        self._call("ListFaces")
+        start = int(NextToken or 0)
+        with self._lock:
+            page = self.indexed[start:start + MaxResults]
+            more = start + MaxResults < len(self.indexed)
+        response = {"Faces": [{"ExternalImageId": external_id} for external_id in page]}
+        if more:
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+# -----------------------------
+# Firestore
+# -----------------------------
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+class FakeDocumentRef:
+    def __init__(self, db, collection, doc_id):
+        self.db = db
+        self.collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self.collection}/{self.id}"
+
+    def get(self):
+        self.db.rpc()
+        return FakeSnapshot(self, self.db.read(self.collection, self.id))
+
+    def set(self, data, merge=False):
+        self.db.rpc()
+        self.db.write(self.collection, self.id, data, merge)
+
+class FakeQuery:
+    OPERATORS = {
+        "==": lambda a, b: a == b,
+        ">=": lambda a, b: a is not None and a >= b,
+        "<=": lambda a, b: a is not None and a <= b,
+    }
+
+    def __init__(self, db, collection, filters=(), orders=(), limit=None, after=None, fields=None):
+        self.db = db
+        self.collection = collection
+        self.filters = filters
+        self.orders = orders
+        self._limit = limit
+        self._after = after
+        self._fields = fields
+
+    def _with(self, **changes):
+        args = dict(filters=self.filters, orders=self.orders, limit=self._limit, after=self._after, fields=self._fields)
+        args.update(changes)
+        return FakeQuery(self.db, self.collection, **args)
+
+    def where(self, field, op, value):
+        return self._with(filters=self.filters + ((field, op, value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._with(orders=self.orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._with(limit=count)
+
+    def start_after(self, snapshot):
+        return self._with(after=snapshot.id)
+
+    def select(self, fields):
+        return self._with(fields=list(fields))
+
+    def document(self, doc_id=None):
+        return FakeDocumentRef(self.db, self.collection, doc_id or self.db.new_id())
+
+    def stream(self):
+        self.db.rpc()
+        with self.db.lock:
+            items = [
+                (doc_id, dict(data)) for doc_id, data in self.db.store[self.collection].items()
+                if all(self.OPERATORS[op](data.get(field), value) for field, op, value in self.filters)
+            ]
+        # Document id breaks ties, as in Firestore
+        items.sort(key=lambda item: item[0])
+        for field, direction in reversed(self.orders):
+            items.sort(key=lambda item: item[1].get(field, ""), reverse=direction == "DESCENDING")
+        if self._after is not None:
+            ids = [doc_id for doc_id, _ in items]
+            items = items[ids.index(self._after) + 1:] if self._after in ids else []
+        if self._limit is not None:
+            items = items[:self._limit]
+        for doc_id, data in items:
+            if self._fields is not None:
+                data = {f: data[f] for f in self._fields if f in data}
+            yield FakeSnapshot(self.document(doc_id), data)
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append((ref, data, merge))
+
+    def delete(self, ref):
+        self.ops.append((ref, None, False))
+
+    def commit(self):
+        self.db.rpc()
+        for ref, data, merge in self.ops:
+            if data is None:
+                self.db.delete(ref.collection, ref.id)
+            else:
+                self.db.write(ref.collection, ref.id, data, merge)
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    A transaction for firestore.transactional. Like the server SDK's
+    pessimistic locking, it holds the database's transaction lock from _begin
+    until _commit or _rollback, and it applies its writes on commit.
+
+    firestore.transactional drives a transaction through private methods and
+    attributes of google-cloud-firestore's Transaction (_begin, _commit,
+    _rollback, _clean_up, _max_attempts, _read_only, _id), so a library upgrade
+    can break this fake even when the app is unaffected.
+    """
+    _max_attempts = 5
+    _read_only = False
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self.ops = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self.db.rpc()
+        self.db.transaction_lock.acquire()
+        self._id = self.db.new_id().encode()
+
+    def get_all(self, refs):
+        return self.db.get_all(refs)
+
+    def _commit(self):
+        try:
+            self.commit()
+        finally:
+            self._release()
+        return []
+
+    def _rollback(self):
+        self._release()
+
+    def _release(self):
+        if self._id is not None:
+            self._id = None
+            self.db.transaction_lock.release()
+
+class FakeFirestore:
+    """
+    In-memory Firestore: collection queries (where/order_by/limit/start_after/select),
+    document get/set, get_all, WriteBatch and transactions, with Increment
+    transforms. Each RPC sleeps for the latency and may raise an injected error.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.store = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.transaction_lock = threading.Lock()
+        self._next_id = 0
+
+    def rpc(self):
+        self.latency.wait()
+        if self.latency.should_fail():
+            raise RuntimeError("Injected Firestore error")
+
+    def new_id(self):
+        with self.lock:
+            self._next_id += 1
+            return f"auto{self._next_id:012d}"
+
+    def read(self, collection, doc_id):
+        with self.lock:
+            data = self.store[collection].get(doc_id)
+            return dict(data) if data is not None else None
+
+    def write(self, collection, doc_id, data, merge):
+        with self.lock:
+            current = dict(self.store[collection].get(doc_id) or {}) if merge else {}
+            for field, value in data.items():
+                if isinstance(value, Increment):
+                    value = current.get(field, 0) + value.value
+                current[field] = value
+            self.store[collection][doc_id] = current
+
+    def delete(self, collection, doc_id):
+        with self.lock:
+            self.store[collection].pop(doc_id, None)
+
+    def collection(self, name):
+        return FakeQuery(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def get_all(self, refs):
+        self.rpc()
+        return [FakeSnapshot(ref, self.read(ref.collection, ref.id)) for ref in refs]
+
+# -----------------------------
+# Gemini
+# -----------------------------
+class FakeGemini:
+    """
+    generate_content returns `reply_words` words; with stream=True they arrive
+    in `chunks` chunks, the latency split between them.
+    """
+    def __init__(self, latency, reply_words=60, chunks=6):
+        self.latency = latency
+        self.reply_words = reply_words
+        self.chunks = max(1, chunks)
+
+    @staticmethod
+    def _response(text):
+        part = type("Part", (), {"text": text})()
+        content = type("Content", (), {"parts": [part]})()
+        return type("Response", (), {"candidates": [type("Candidate", (), {"content": content})()]})()
+
+    def _fail(self):
+        if self.latency.should_fail():
+            raise RuntimeError("Injected Gemini error")
+
+    def generate_content(self, prompt, stream=False):
+        words = ["word"] * self.reply_words
+        if not stream:
+            self.latency.wait()
+            self._fail()
+            return self._response(" ".join(words))
+        return self._stream(words)
+
+    def _stream(self, words):
+        per_chunk = Latency(self.latency.mean_ms / self.chunks, self.latency.jitter_ms / self.chunks)
+        size = max(1, len(words) // self.chunks)
+        for start in range(0, len(words), size):
+            per_chunk.wait()
+            self._fail()
+            yield self._response(" ".join(words[start:start + size]) + " ")
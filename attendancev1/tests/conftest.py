@@ -0,0 +1,44 @@
+"""
+Shared fixtures: app.py imported once with the local fakes from
+benchmarks/fakes.py in place of Rekognition, Firestore and Gemini.
+
+Run from attendancev1/:  python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, "benchmarks"))
+
+from fakes import FakeFirestore, FakeGemini, FakeRekognition, Latency
+
+@pytest.fixture(scope="session")
+def attendance():
+    # Settings read by app.py at import time
+    os.environ["APP_WARMUP"] = "0"
+    os.environ["REKOGNITION_BACKOFF_BASE"] = "0.001"
+    os.environ["FACE_CACHE_SIZE"] = "0"
+    os.environ["CHAT_CACHE_SIZE"] = "0"
+    import app
+    return app
+
+@pytest.fixture
+def fakes(attendance):
+    """
+    Fresh fake clients for each test, without latency or injected errors.
+    """
+    clients = {
+        "rekognition": FakeRekognition(Latency(), faces_per_photo=3, students=20),
+        "firestore": FakeFirestore(Latency()),
+        "gemini": FakeGemini(Latency()),
+    }
+    for lazy in attendance.LAZY_CLIENTS:
+        lazy.set(clients[lazy.name])
+    return clients
+
+@pytest.fixture
+def client(attendance, fakes):
+    return attendance.app.test_client()
@@ -0,0 +1,59 @@
+import io
+
+import openpyxl
+
+RECORD = {
+    "student_id": "S1",
+    "name": "Student 1",
+    "subject_id": "math",
+    "subject_name": "Math",
+    "timestamp": "2024-01-01T09:00:00",
+    "status": "PRESENT",
+}
+
+def counts(db, attendance):
+    return {
+        doc_id: data["count"]
+        for doc_id, data in db.store[attendance.AGGREGATES_COLLECTION].items()
+        if data["count"]
+    }
+
+def test_update_with_repeated_doc_id_moves_counters_once(attendance, fakes, client):
+    db = fakes["firestore"]
+    db.store["attendance"]["r1"] = dict(RECORD)
+    db.store[attendance.AGGREGATES_COLLECTION].update({
+        "subject_day|math|2024-01-01": {"count": 1},
+        "student_subject|S1|math": {"count": 1},
+    })
+
+    response = client.post("/api/attendance/update", json={"records": [
+        {**RECORD, "doc_id": "r1", "subject_id": "art"},
+        {**RECORD, "doc_id": "r1", "subject_id": "music"},
+    ]})
+
+    assert response.status_code == 200
+    assert db.store["attendance"]["r1"]["subject_id"] == "music"
+    assert counts(db, attendance) == {
+        "subject_day|music|2024-01-01": 1,
+        "student_subject|S1|music": 1,
+    }
+
+def test_import_with_repeated_doc_id_counts_record_once(attendance, fakes, client):
+    db = fakes["firestore"]
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(attendance.ATTENDANCE_HEADERS)
+    for status in ("PRESENT", "PRESENT", "ABSENT", "PRESENT"):
+        ws.append(["r1"] + [RECORD[h] if h != "status" else status for h in attendance.ATTENDANCE_HEADERS[1:]])
+    upload = io.BytesIO()
+    wb.save(upload)
+    upload.seek(0)
+
+    response = client.post("/api/attendance/upload", data={"file": (upload, "attendance.xlsx")})
+
+    assert response.status_code == 200, response.get_json()
+    assert db.store["attendance"]["r1"]["status"] == "PRESENT"
+    assert counts(db, attendance) == {
+        "subject_day|math|2024-01-01": 1,
+        "student_subject|S1|math": 1,
+    }
@@ -0,0 +1,18 @@
+def face(left, top, width, height, confidence):
+    return {
+        "BoundingBox": {"Left": left, "Top": top, "Width": width, "Height": height},
+        "Confidence": confidence,
+    }
+
+def test_merge_keeps_whole_face_over_more_confident_half_face(attendance):
+    whole = face(0.40, 0.20, 0.10, 0.12, 98.0)
+    half = face(0.45, 0.20, 0.05, 0.12, 99.9)  # cut at a tile border
+
+    assert attendance.merge_duplicate_faces([half, whole]) == [whole]
+
+def test_merge_keeps_separate_faces_in_reading_order(attendance):
+    right = face(0.60, 0.20, 0.10, 0.12, 99.0)
+    left = face(0.10, 0.20, 0.10, 0.12, 95.0)
+    below = face(0.10, 0.60, 0.10, 0.12, 97.0)
+
+    assert attendance.merge_duplicate_faces([below, right, left]) == [left, right, below]
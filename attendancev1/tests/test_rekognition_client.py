@@ -0,0 +1,45 @@
+import pytest
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError
+
+class FlakyClient:
+    """
+    detect_faces raises the queued errors in order, then succeeds.
+    """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def detect_faces(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"FaceDetails": []}
+
+def wrap(attendance, client):
+    return attendance.RekognitionClient(client, tps=0, max_attempts=3, backoff_base=0.001, backoff_max=0.001)
+
+@pytest.mark.parametrize("error", [
+    EndpointConnectionError(endpoint_url="https://rekognition.example"),
+    ConnectTimeoutError(endpoint_url="https://rekognition.example"),
+])
+def test_connection_errors_are_retried(attendance, error):
+    client = FlakyClient(error)
+
+    assert wrap(attendance, client).detect_faces(Image={}) == {"FaceDetails": []}
+    assert client.calls == 2
+
+def test_connection_errors_raise_after_max_attempts(attendance):
+    errors = [EndpointConnectionError(endpoint_url="https://rekognition.example") for _ in range(3)]
+    client = FlakyClient(*errors)
+
+    with pytest.raises(EndpointConnectionError):
+        wrap(attendance, client).detect_faces(Image={})
+    assert client.calls == 3
+
+def test_client_errors_are_not_retried(attendance):
+    error = ClientError({"Error": {"Code": "InvalidParameterException"}}, "DetectFaces")
+    client = FlakyClient(error)
+
+    with pytest.raises(ClientError):
+        wrap(attendance, client).detect_faces(Image={})
+    assert client.calls == 1
@@ -0,0 +1,133 @@
+import cv2
+import numpy as np
+import pytest
+from botocore.exceptions import ClientError
+
+def box(left, top, width=0.2, height=0.2):
+    return {"Left": left, "Top": top, "Width": width, "Height": height}
+
+def frame_bytes(shade):
+    image = np.full((240, 320, 3), shade, dtype=np.uint8)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+MATCH = {"FaceMatches": [{"Similarity": 99.0, "Face": {"ExternalImageId": "Ada_S1", "Confidence": 99.5}}]}
+
+class ScriptedRekognition:
+    """
+    search_faces_by_image returns (or raises) the queued results in order.
+    """
+    def __init__(self, *results):
+        self.results = list(results)
+        self.searches = 0
+
+    def search_faces_by_image(self, **kwargs):
+        self.searches += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+@pytest.fixture
+def stream(attendance, fakes, monkeypatch):
+    monkeypatch.setattr(attendance, "STREAM_DETECT_INTERVAL", 0.0)
+    detections = []
+
+    def detect(cv_image, image_size, endpoint="recognize"):
+        result = detections.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return [{"BoundingBox": b, "Confidence": 99.0} for b in result]
+
+    monkeypatch.setattr(attendance, "detect_faces_predetected", detect)
+    session = attendance.StreamSession(subject_id="math")
+    session.detections = detections
+    return session
+
+def use_rekognition(attendance, client):
+    attendance.rekognition_client._client.set(client)
+    return client
+
+# -----------------------------
+# FaceTracker
+# -----------------------------
+def test_tracker_continues_overlapping_and_nearby_boxes(attendance):
+    tracker = attendance.FaceTracker(iou_threshold=0.3, ttl=3)
+    first = tracker.update([box(0.1, 0.1), box(0.6, 0.1)], now=0)
+    assert [t.id for t in first] == [1, 2]
+
+    # A small shift keeps the track by overlap, a larger one by distance
+    assert tracker.update([box(0.12, 0.1), box(0.75, 0.1)], now=1) == []
+    assert tracker.tracks[1].box == box(0.12, 0.1)
+    assert tracker.tracks[2].box == box(0.75, 0.1)
+
+def test_tracker_starts_new_track_for_distant_box(attendance):
+    tracker = attendance.FaceTracker(iou_threshold=0.3, ttl=3)
+    tracker.update([box(0.1, 0.1)], now=0)
+
+    new = tracker.update([box(0.7, 0.7)], now=1)
+
+    assert [t.id for t in new] == [2]
+    assert set(tracker.tracks) == {1, 2}
+
+def test_tracker_drops_tracks_unseen_for_ttl(attendance):
+    tracker = attendance.FaceTracker(iou_threshold=0.3, ttl=3)
+    tracker.update([box(0.1, 0.1)], now=0)
+    tracker.touch(2)
+
+    new = tracker.update([box(0.1, 0.1)], now=4)
+    assert new == []
+
+    tracker.update([], now=8)
+    assert tracker.tracks == {}
+
+# -----------------------------
+# StreamSession
+# -----------------------------
+def test_still_scene_is_not_detected_again(attendance, stream):
+    use_rekognition(attendance, ScriptedRekognition(MATCH))
+    stream.detections.append([box(0.3, 0.3)])
+
+    assert stream.process_frame(frame_bytes(100))["outcome"] == "detected"
+    state = stream.process_frame(frame_bytes(100))
+
+    assert state["outcome"] == "no_motion"
+    assert [t["status"] for t in state["tracks"]] == ["recognized"]
+    assert [p["student_id"] for p in state["logged"]] == ["S1"]
+
+def test_failed_detection_is_retried_on_unchanged_scene(attendance, stream):
+    use_rekognition(attendance, ScriptedRekognition(MATCH))
+    stream.detections.extend([RuntimeError("detect_faces failed"), [box(0.3, 0.3)]])
+
+    with pytest.raises(RuntimeError):
+        stream.process_frame(frame_bytes(100))
+    state = stream.process_frame(frame_bytes(100))
+
+    assert state["outcome"] == "detected"
+    assert [p["student_id"] for p in state["newly_logged"]] == ["S1"]
+
+def test_failed_search_keeps_track_searching_until_retried(attendance, stream):
+    error = ClientError({"Error": {"Code": "InvalidParameterException"}}, "SearchFacesByImage")
+    rekognition = use_rekognition(attendance, ScriptedRekognition(error, MATCH))
+    stream.detections.extend([[box(0.3, 0.3)], [box(0.31, 0.3)]])
+
+    state = stream.process_frame(frame_bytes(100))
+    assert [t["status"] for t in state["tracks"]] == ["searching"]
+    assert state["logged"] == []
+
+    # The scene has not changed, but the searching track forces a detection
+    state = stream.process_frame(frame_bytes(100))
+    assert state["outcome"] == "detected"
+    assert [(t["track_id"], t["status"]) for t in state["tracks"]] == [(1, "recognized")]
+    assert [p["student_id"] for p in state["newly_logged"]] == ["S1"]
+    assert rekognition.searches == 2
+
+def test_unknown_track_is_not_searched_again(attendance, stream):
+    rekognition = use_rekognition(attendance, ScriptedRekognition({"FaceMatches": []}))
+    stream.detections.extend([[box(0.3, 0.3)], [box(0.32, 0.3)]])
+
+    stream.process_frame(frame_bytes(100))
+    state = stream.process_frame(frame_bytes(160))
+
+    assert state["outcome"] == "detected"
+    assert [t["status"] for t in state["tracks"]] == ["unknown"]
+    assert rekognition.searches == 1
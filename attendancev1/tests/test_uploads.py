@@ -0,0 +1,36 @@
+import asyncio
+import json
+
+import pytest
+
+@pytest.mark.parametrize("body", [[1, 2], "abc", 5, {"image": 5}])
+@pytest.mark.parametrize("path", ["/recognize", "/register"])
+def test_non_object_json_body_is_rejected(client, path, body):
+    response = client.post(path, json=body)
+
+    assert response.status_code == 400
+    assert response.get_json() == {"message": "Invalid image data"}
+
+def test_asgi_rejects_non_object_json_body(fakes):
+    import asgi
+
+    body = json.dumps([1, 2]).encode("utf-8")
+    scope = {
+        "type": "http",
+        "path": "/recognize",
+        "method": "POST",
+        "headers": [(b"content-type", b"application/json")],
+        "query_string": b"",
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+
+    assert sent[0]["status"] == 400
+    assert json.loads(sent[1]["body"]) == {"message": "Invalid image data"}